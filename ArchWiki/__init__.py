@@ -6,3 +6,4 @@ __version__ = "0.3"
 
 from .downloader import *
 from .optimizer import *
+from .metrics import *
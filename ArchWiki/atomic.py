@@ -0,0 +1,36 @@
+import contextlib
+import os
+from collections.abc import Callable, Iterator
+from typing import IO
+
+
+@contextlib.contextmanager
+def atomic_path(path: str, suffix: str = ".tmp") -> Iterator[str]:
+    """
+    Yield a temporary path next to @path, to be written by the block. When
+    the block succeeds, the temporary file is moved over @path, so readers
+    never see a partial file. If the block fails, the temporary file is
+    removed; if the block removes it, @path is left untouched.
+    """
+    tmp = path + suffix
+    try:
+        yield tmp
+        if os.path.exists(tmp):
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+@contextlib.contextmanager
+def atomic_open(
+    path: str, mode: str = "w", opener: Callable[..., IO] = open, **kwargs
+) -> Iterator[IO]:
+    """
+    Open a temporary file for writing and move it over @path when the block
+    succeeds, see atomic_path. @opener (e.g. gzip.open) is called with the
+    temporary path, @mode and @kwargs.
+    """
+    with atomic_path(path) as tmp:
+        with opener(tmp, mode, **kwargs) as fd:
+            yield fd
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import os
+
+import requests
+
+from .atomic import atomic_open
+
+
+class ResponseCache:
+    """
+    Local cache of HTTP response validators. For each URL it stores the
+    'ETag' and 'Last-Modified' headers sent by the server, so that later runs
+    can issue conditional requests. The body is not stored here, the caller
+    has to keep it elsewhere (see RawCache) and store the validators only
+    after the body was saved. The validators of an incomplete download are
+    kept separately (@partial=True), for resuming it with a range request.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, url: str, suffix: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def _write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path, "wb") as fd:
+            fd.write(data)
+
+    def _suffix(self, partial: bool) -> str:
+        return ".part.json" if partial else ".json"
+
+    def metadata(self, url: str, partial: bool = False) -> dict | None:
+        try:
+            with open(self._path(url, self._suffix(partial))) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def validators(self, url: str, partial: bool = False) -> dict[str, str]:
+        """Return headers for a conditional request of @url."""
+        meta = self.metadata(url, partial)
+        if meta is None:
+            return {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(self, url: str, response: requests.Response, partial: bool = False) -> None:
+        """
+        Store the validators of @response. Responses without any validator
+        are not cached.
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        self._write(self._path(url, self._suffix(partial)), json.dumps(meta).encode("utf-8"))
+
+    def discard(self, url: str, partial: bool = False) -> None:
+        try:
+            os.unlink(self._path(url, self._suffix(partial)))
+        except FileNotFoundError:
+            pass
+
+
+class RawCache:
+    """
+    Compressed copies of the unmodified HTML of the downloaded pages. The
+    cache mirrors the layout of the output directory, so that the optimized
+    pages can be regenerated without downloading them again.
+    """
+
+    def __init__(self, directory: str, base_directory: str):
+        """
+        @directory:      where to store the compressed files
+        @base_directory: output directory containing the optimized pages
+        """
+        self.directory = directory
+        self.base_directory = base_directory
+
+    def path(self, fname: str) -> str:
+        relpath = os.path.relpath(fname, self.base_directory)
+        return os.path.join(self.directory, relpath + ".gz")
+
+    def exists(self, fname: str) -> bool:
+        return os.path.exists(self.path(fname))
+
+    def save(self, fname: str, html: str) -> None:
+        path = self.path(fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path, "wt", gzip.open, encoding="utf-8") as fd:
+            fd.write(html)
+
+    def load(self, fname: str) -> str | None:
+        try:
+            with gzip.open(self.path(fname), "rt", encoding="utf-8") as fd:
+                return fd.read()
+        except FileNotFoundError:
+            return None
+
+    def remove(self, fname: str) -> None:
+        try:
+            os.unlink(self.path(fname))
+        except FileNotFoundError:
+            pass
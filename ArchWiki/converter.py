@@ -1,7 +1,11 @@
 #! /usr/bin/env python3
 
+import concurrent.futures
+import contextlib
+import hashlib
 import os
 import subprocess
+import time
 
 # for filter_pre
 import lxml.etree
@@ -11,18 +15,73 @@ import lxml.html
 import json
 import pandocfilters
 
+try:
+    from .atomic import atomic_open
+except ImportError:
+    # executed as a script
+    from atomic import atomic_open
+
 class PandocError(Exception):
     def __init__(self, retcode, errs):
         Exception.__init__(self, "pandoc failed with return code %s\nstderr:\n%s" % (retcode, errs))
 
+# errors which fail the conversion of a single page: pandoc failures and
+# filters rejecting unexpected input (e.g. a page without #bodyContent or an
+# unknown layout of the pandoc AST)
+CONVERSION_ERRORS = (PandocError, ValueError, LookupError)
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    """Add the time spent in the block to timings[stage]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+def write_if_changed(fname, content):
+    """
+    Write content to fname unless the file already has the same content, so
+    that unchanged outputs keep their mtime. Returns True if it was written.
+    """
+    try:
+        with open(fname, "r") as f:
+            if f.read() == content:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    with open(fname, "w") as f:
+        f.write(content)
+    return True
+
+def lua_filter_of(filter_inst):
+    """
+    Return the Lua filter doing the same as filter_in of filter_inst, or None
+    if there is none (including when a subclass overrides filter_in).
+    """
+    for cls in type(filter_inst).__mro__:
+        if "lua_filter" in vars(cls):
+            if getattr(cls, "filter_in", None) is type(filter_inst).filter_in:
+                return cls.lua_filter
+            return None
+    return None
+
 class ManFilter:
     format = "man"
 
+    # Lua filter doing the same as filter_in inside pandoc
+    lua_filter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "man.lua")
+
     def filter_pre(self, instring):
-        root = lxml.html.fromstring(instring)
+        return self.filter_pre_tree(lxml.html.fromstring(instring))
 
+    def filter_pre_tree(self, root):
+        """filter_pre for a page already parsed by lxml, the tree is modified"""
         # force headers to start from level 1
-        content = root.cssselect("#bodyContent")[0]
+        content = root.cssselect("#bodyContent")
+        if len(content) == 0:
+            raise ValueError("not a wiki page, #bodyContent not found")
+        content = content[0]
         headers = content.cssselect("h1, h2, h3, h4, h5, h6")
         if len(headers) > 0:
             top_level = int(headers[0].tag[-1])
@@ -42,12 +101,12 @@ class ManFilter:
 
         return lxml.etree.tostring(root, encoding="unicode", method="html", doctype="<!DOCTYPE html>")
 
-    def filter_in(self, instring):
+    def filter_in(self, instring, format=None):
         def _filter(key, value, format, meta):
             # remove HTML specific stuff
             if key == "Link":
                 # remove relative path prefix and .html suffix
-                internal, [href, text] = value
+                attr, inlines, [href, title] = value
                 if href.endswith(".html"):
                     href = href[:-5]
 # FIXME: this stupid detection will not work
@@ -56,7 +115,7 @@ class ManFilter:
 #                        href = href[2:]
 #                    elif href.startswith("../"):
 #                        href = href[3:]
-                return pandocfilters.Link(internal, [href, text])
+                return pandocfilters.Link(attr, inlines, [href, title])
             
 # TODO: it's implemented in filter_pre, but could be useful anyway since html may not be
 #       the only input format; the most generic way should be implemented
@@ -74,70 +133,306 @@ class ManFilter:
 #                return pandocfilters.Header(level, classes, internal)
 
         doc = json.loads(instring)
-        altered = pandocfilters.walk(doc, _filter, self.format, doc[0]["unMeta"])
+        if isinstance(doc, dict):
+            # pandoc >= 1.18: {"pandoc-api-version": ..., "meta": ..., "blocks": ...}
+            meta = doc["meta"]
+        else:
+            # older pandoc: [{"unMeta": ...}, blocks]
+            meta = doc[0]["unMeta"]
+        altered = pandocfilters.walk(doc, _filter, format or self.format, meta)
         return json.dumps(altered)
 
     def filter_post(self, instring):
         return instring
 
+class ConversionManifest:
+    """
+    Record of converted source files (size, mtime and SHA-256 hash) and their
+    outputs, stored as a JSON file in the output directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def hash_file(path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def is_current(self, source, infile, outfiles):
+        """
+        Check if the outputs of @source (path relative to the input directory)
+        are up-to-date. The hash of the source is computed only when its size
+        or mtime changed.
+        """
+        entry = self.entries.get(source)
+        if entry is None or not all(os.path.exists(outfile) for outfile in outfiles):
+            return False
+        st = os.stat(infile)
+        if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return True
+        if entry["hash"] == self.hash_file(infile):
+            # touched, but not changed
+            entry["size"] = st.st_size
+            entry["mtime"] = st.st_mtime
+            return True
+        return False
+
+    def record(self, source, infile, output):
+        st = os.stat(infile)
+        self.entries[source] = {
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "hash": self.hash_file(infile),
+            "output": output,
+        }
+
+    def save(self):
+        with atomic_open(self.path) as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
 class Converter:
-    def __init__(self, filter_inst, input_dir, output_dir, output_format):
+    manifest_name = ".convert-manifest.json"
+
+    # top-level directories of the input which do not contain pages, e.g. the
+    # search index exported by the downloader (see ArchWiki.search)
+    skip_dirs = ["search"]
+
+    # file name extensions of the output formats, the format name by default
+    extensions = {
+        "markdown": "md",
+        "gfm": "md",
+        "plain": "txt",
+    }
+
+    def __init__(self, filter_inst, input_dir, output_dir, output_format, workers=1, incremental=False, backend="lua", verbose=False):
+        """
+        @filter_inst:   filter object (e.g. ManFilter) applied to each page
+        @input_dir:     directory with the optimized HTML pages
+        @output_dir:    where to store the converted pages
+        @output_format: pandoc output format
+        @workers:       number of pages converted in parallel
+        @incremental:   convert only pages changed since the last run and
+                        delete outputs of removed pages
+        @backend:       "lua" runs pandoc once per page with the Lua filter of
+                        @filter_inst, "json" runs pandoc twice and applies
+                        filter_in to the JSON AST in between; "lua" falls back
+                        to "json" if @filter_inst has no Lua filter
+        @verbose:       print a line for each processed page
+        """
         self.filter = filter_inst
         self.input_dir = os.path.abspath(input_dir)
         self.output_dir = os.path.abspath(output_dir)
         self.output_format = output_format
+        self.workers = max(workers, 1)
+        self.incremental = incremental
+        if backend == "lua" and lua_filter_of(filter_inst) is None:
+            backend = "json"
+        self.backend = backend
+        self.verbose = verbose
+
+        # total time spent in each stage of convert_file
+        self.timings = {}
 
         # ensure output directory always exists
         if not os.path.isdir(self.output_dir):
             os.mkdir(self.output_dir)
 
-    def convert(self):
+    def get_output_filename(self, infile):
+        outfile = os.path.join(self.output_dir, os.path.relpath(infile, self.input_dir))
+        return os.path.splitext(outfile)[0] + "." + self.extensions.get(self.output_format, self.output_format)
+
+    def output_filenames(self, outfile):
+        """All files produced from the page whose output is @outfile."""
+        return [outfile]
+
+    def output_directories(self):
+        """All directories where the outputs are stored."""
+        return [self.output_dir]
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def convert(self, metrics=None):
+        """
+        Convert all pages in the input directory. Counters and stage timings
+        are added to @metrics (a Metrics instance) if given, otherwise the
+        timings are printed at the end.
+        """
         failed = []
+        jobs = []
 
         for path, dirs, files in os.walk(self.input_dir):
+            # skip hidden directories, e.g. the state of the downloader
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if path == self.input_dir:
+                dirs[:] = [d for d in dirs if d not in self.skip_dirs]
             for f in files:
                 infile = os.path.join(path, f)
-                outdir = os.path.join(self.output_dir, os.path.relpath(path, self.input_dir))
-                outfile = os.path.join(os.path.normpath(outdir), f)
-                outfile = os.path.splitext(outfile)[0] + "." + self.output_format
                 if infile.endswith(".html"):
-                    try:
-                        self.convert_file(infile, outfile)
-                    except PandocError as e:
-                        failed.append(infile)
-                        print(e)
-                        print("  [conv failed] %s" % infile)
+                    jobs.append((infile, self.get_output_filename(infile)))
                 else:
-                    print("  [skip conv]   %s" % infile)
-        
+                    self.log("  [skip conv]   %s" % infile)
+
+        if self.incremental:
+            manifest = ConversionManifest(os.path.join(self.output_dir, self.manifest_name))
+            jobs = self.filter_jobs(jobs, manifest)
+            if metrics is not None:
+                metrics.count("up_to_date", self.up_to_date)
+
+        if self.workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = pool.map(self.run_job, *zip(*jobs), chunksize=16) if jobs else []
+                self._collect(jobs, results, failed, metrics)
+        else:
+            self._collect(jobs, (self.run_job(*job) for job in jobs), failed, metrics)
+
+        if self.incremental:
+            failed_set = set(failed)
+            for infile, outfile in jobs:
+                if infile not in failed_set:
+                    manifest.record(os.path.relpath(infile, self.input_dir), infile,
+                                    os.path.relpath(outfile, self.output_dir))
+            manifest.save()
+
+        if metrics is not None:
+            metrics.end_progress()
+            metrics.add_times(self.timings, prefix="convert_")
+        elif self.timings:
+            print("time spent in conversion stages (summed over workers):")
+            for stage, seconds in self.timings.items():
+                print("  %-12s %10.3f s" % (stage, seconds))
+
         if len(failed) > 0:
             print("failed to convert %d pages:" % len(failed))
             for f in failed:
                 print("  %s" % f)
 
-    def convert_file(self, infile, outfile):
-        print("  [converting]  %s" % infile)
+    def filter_jobs(self, jobs, manifest):
+        """
+        Return only jobs whose source changed since the last run, delete
+        outputs of sources which no longer exist.
+        """
+        sources = set()
+        outdated = []
+        self.up_to_date = 0
+        for infile, outfile in jobs:
+            source = os.path.relpath(infile, self.input_dir)
+            sources.add(source)
+            if manifest.is_current(source, infile, self.output_filenames(outfile)):
+                self.log("  [up-to-date]  %s" % infile)
+                self.up_to_date += 1
+            else:
+                outdated.append((infile, outfile))
+
+        for source in sorted(set(manifest.entries) - sources):
+            outfile = os.path.join(self.output_dir, manifest.entries.pop(source)["output"])
+            for outfile in self.output_filenames(outfile):
+                if os.path.exists(outfile):
+                    self.log("  [deleting]    %s" % outfile)
+                    os.unlink(outfile)
+
+        return outdated
+
+    def run_job(self, infile, outfile):
+        """
+        Convert one page, return the error message if the conversion failed
+        and the timings of the conversion stages.
+        """
+        timings = {}
+        try:
+            self.convert_file(infile, outfile, timings)
+        except CONVERSION_ERRORS as e:
+            return "%s: %s" % (type(e).__name__, e), timings
+        return None, timings
+
+    def run_tree_job(self, root, infile, timings):
+        """
+        Same as run_job for convert_tree, return the converted content (None
+        if the conversion failed) and the error message.
+        """
+        try:
+            return self.convert_tree(root, infile, timings), None
+        except CONVERSION_ERRORS as e:
+            return None, "%s: %s" % (type(e).__name__, e)
 
+    def _collect(self, jobs, results, failed, metrics=None):
+        for (infile, outfile), (error, timings) in zip(jobs, results):
+            for stage, seconds in timings.items():
+                self.timings[stage] = self.timings.get(stage, 0) + seconds
+            if metrics is not None:
+                metrics.add_time("convert", sum(timings.values()))
+                metrics.count("pages_converted" if error is None else "errors")
+            if error is not None:
+                failed.append(infile)
+                print(error)
+                print("  [conv failed] %s" % infile)
+
+    def convert_file(self, infile, outfile, timings=None):
+        self.log("  [converting]  %s" % infile)
+        if timings is None:
+            timings = self.timings
+
+        with timed(timings, "read"):
+            content = open(infile, "r").read()
+        with timed(timings, "filter_pre"):
+            content = self.filter.filter_pre(content)
+        return self.convert_string(content, outfile, timings)
+
+    def convert_tree(self, root, infile, timings=None):
+        """
+        Convert a page already parsed by lxml, e.g. the tree returned by
+        Optimizer.optimize_tree, without reading and parsing it again. The
+        tree is modified. @infile is the path of the page in the input
+        directory, it does not have to exist. Returns the converted content.
+        """
+        outfile = self.get_output_filename(infile)
+        self.log("  [converting]  %s" % infile)
+        if timings is None:
+            timings = self.timings
+
+        with timed(timings, "filter_pre"):
+            content = self.filter.filter_pre_tree(root)
+        return self.convert_string(content, outfile, timings)
+
+    def convert_string(self, content, outfile, timings):
+        """Run the pre-filtered HTML through pandoc and write the result to outfile."""
         # ensure that target directory exists (necessary for subpages)
         try:
             os.makedirs(os.path.split(outfile)[0])
         except FileExistsError:
             pass
 
-        content = open(infile, "r").read()
-        content = self.filter.filter_pre(content)
-        content = self.pandoc_first(content)
-        content = self.filter.filter_in(content)
-        content = self.pandoc_last(content)
-        content = self.filter.filter_post(content)
+        if self.backend == "lua":
+            with timed(timings, "pandoc"):
+                content = self.pandoc_single(content)
+        else:
+            with timed(timings, "pandoc_first"):
+                content = self.pandoc_first(content)
+            with timed(timings, "filter_in"):
+                content = self.filter.filter_in(content)
+            with timed(timings, "pandoc_last"):
+                content = self.pandoc_last(content)
+        with timed(timings, "filter_post"):
+            content = self.filter.filter_post(content)
 
-        f = open(outfile, "w")
-        f.write(content)
-        f.close()
+        with timed(timings, "write"):
+            write_if_changed(outfile, content)
+        return content
 
     def run_pandoc(self, cmd, instring):
-        popen = subprocess.Popen(cmd, shell=True, universal_newlines=True,
-                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        popen = subprocess.Popen(cmd, universal_newlines=True, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         outs, errs = popen.communicate(instring)
 
         if popen.returncode != 0:
@@ -146,12 +441,117 @@ class Converter:
         return outs
 
     def pandoc_first(self, instring):
-        return self.run_pandoc("pandoc -s -f html -t json", instring)
+        return self.run_pandoc(["pandoc", "-s", "-f", "html", "-t", "json"], instring)
 
-    def pandoc_last(self, instring):
-        return self.run_pandoc("pandoc -s -f json -t %s" % self.output_format, instring)
+    def pandoc_last(self, instring, output_format=None):
+        return self.run_pandoc(["pandoc", "-s", "-f", "json", "-t", output_format or self.output_format], instring)
+
+    def pandoc_single(self, instring):
+        return self.run_pandoc(["pandoc", "-s", "-f", "html", "-t", self.output_format,
+                                "--lua-filter", lua_filter_of(self.filter)], instring)
+
+class MultiFormatConverter(Converter):
+    """
+    Converter rendering several output formats from a single pandoc AST per
+    page: filter_pre and the HTML -> JSON run of pandoc are done once, then
+    filter_in and the JSON -> output run of pandoc for each format.
+
+    The first format is the primary one, its output directory holds the
+    manifest of the incremental mode and get_output_filename returns its
+    output.
+    """
+
+    def __init__(self, filters, input_dir, outputs, workers=1, incremental=False, verbose=False):
+        """
+        @filters:     mapping of output formats to filter objects (e.g.
+                      ManFilter); filter_pre of the primary format is used
+                      for all formats
+        @outputs:     mapping of pandoc output formats to output directories
+        other parameters are the same as for Converter
+        """
+        formats = list(outputs)
+        primary = formats[0]
+        Converter.__init__(self, filters[primary], input_dir, outputs[primary], primary,
+                           workers=workers, incremental=incremental, backend="json", verbose=verbose)
+        self.filters = filters
+        self.outputs = {}
+        for output_format in formats:
+            output_dir = os.path.abspath(outputs[output_format])
+            if not os.path.isdir(output_dir):
+                os.mkdir(output_dir)
+            self.outputs[output_format] = output_dir
+
+    def output_filename(self, outfile, output_format):
+        """Output of @output_format for the page whose primary output is @outfile."""
+        relpath = os.path.splitext(os.path.relpath(outfile, self.output_dir))[0]
+        return os.path.join(self.outputs[output_format],
+                            relpath + "." + self.extensions.get(output_format, output_format))
+
+    def output_filenames(self, outfile):
+        return [self.output_filename(outfile, output_format) for output_format in self.outputs]
+
+    def output_directories(self):
+        return list(self.outputs.values())
+
+    def convert_string(self, content, outfile, timings):
+        with timed(timings, "pandoc_first"):
+            ast = self.pandoc_first(content)
+
+        primary = None
+        for output_format in self.outputs:
+            fmt_filter = self.filters[output_format]
+            fmt_outfile = self.output_filename(outfile, output_format)
+            try:
+                os.makedirs(os.path.split(fmt_outfile)[0])
+            except FileExistsError:
+                pass
+
+            with timed(timings, "filter_in"):
+                content = fmt_filter.filter_in(ast, output_format)
+            with timed(timings, "pandoc_last"):
+                content = self.pandoc_last(content, output_format)
+            with timed(timings, "filter_post"):
+                content = fmt_filter.filter_post(content)
+            with timed(timings, "write"):
+                write_if_changed(fmt_outfile, content)
+            if primary is None:
+                primary = content
+        return primary
 
 if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="Convert pages downloaded by arch-wiki-docs.py to man pages")
+    argparser.add_argument("input_dir", nargs="?", default="./wiki/", help="Directory with the downloaded pages (default: %(default)s).")
+    argparser.add_argument("output_dir", nargs="?", default="./output/", help="Where to store the converted pages (default: %(default)s).")
+    argparser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of pages converted in parallel (default: %(default)s).")
+    argparser.add_argument("--incremental", action="store_true", help="Convert only pages changed since the last run and delete outputs of removed pages.")
+    argparser.add_argument("--backend", choices=["lua", "json"], default="lua", help="Run pandoc once per page with a Lua filter (lua) or twice with a JSON filter in between (json). Default: %(default)s.")
+    argparser.add_argument("--extra-format", action="append", default=[], metavar="FORMAT:DIR", help="Render also this pandoc output format into DIR, from the same parsed page (implies --backend json). Can be given multiple times.")
+    argparser.add_argument("--verbose", action="store_true", help="Print a line for each processed page instead of the progress line.")
+    argparser.add_argument("--metrics-file", help="Write counters and per-stage timings to this file at the end. The Prometheus textfile format is used for files with the '.prom' extension, JSON otherwise.")
+    args = argparser.parse_args()
+
+    try:
+        from .metrics import Metrics
+    except ImportError:
+        # executed as a script
+        from metrics import Metrics
+
+    metrics = Metrics(verbose=args.verbose)
     f = ManFilter()
-    c = Converter(f, "./wiki/", "./output/", "man")
-    c.convert()
+    if args.extra_format:
+        outputs = {"man": args.output_dir}
+        for spec in args.extra_format:
+            output_format, _, output_dir = spec.partition(":")
+            if not output_dir:
+                argparser.error("--extra-format must be given as FORMAT:DIR")
+            outputs[output_format] = output_dir
+        filters = {output_format: f for output_format in outputs}
+        c = MultiFormatConverter(filters, args.input_dir, outputs, workers=args.workers, incremental=args.incremental, verbose=args.verbose)
+    else:
+        c = Converter(f, args.input_dir, args.output_dir, "man", workers=args.workers, incremental=args.incremental, backend=args.backend, verbose=args.verbose)
+    c.convert(metrics)
+    metrics.report()
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
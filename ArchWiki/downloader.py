@@ -1,9 +1,65 @@
-import os
+import concurrent.futures
 import datetime
+import email.utils
+import hashlib
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import urllib.parse
 
+import requests
+import requests.adapters
 from ws.client.api import API
 
-from .optimizer import Optimizer
+from .atomic import atomic_open
+from .cache import RawCache, ResponseCache
+from .manifest import Manifest, hash_file
+from .images import ImageOptimizer
+from .metrics import Metrics
+from .optimizer import OptimizedPage, Optimizer
+from .pack import write_pack
+from .search import SearchIndex
+from .shard import Shard
+from .snapshot import SiteSnapshot
+from .sync import SyncState, parse_timestamp, query_titles, recent_changes
+
+# Optimizer and Converter instances of a worker process, inherited from the parent on fork
+_worker_optimizer: Optimizer | None = None
+_worker_converter = None
+
+
+def _init_optimizer_worker(optimizer: Optimizer, converter) -> None:
+    global _worker_optimizer, _worker_converter
+    _worker_optimizer = optimizer
+    _worker_converter = converter
+
+
+def _optimize_in_worker(
+    fname: str, html: str, extract_text: bool, serialize: bool
+) -> OptimizedPage:
+    assert _worker_optimizer is not None
+    index = _worker_optimizer.link_index.index
+    known = len(index)
+    page = _worker_optimizer.optimize_page(
+        fname, html, extract_text, serialize, _worker_converter
+    )
+    # entries are only added by resolve(), so the new ones are at the end
+    page.links = dict(itertools.islice(index.items(), known, None))
+    return page
+
+
+def _reoptimize_in_worker(
+    raw_cache: RawCache, fname: str, extract_text: bool, serialize: bool
+) -> tuple[OptimizedPage | None, float]:
+    html = raw_cache.load(fname)
+    if html is None:
+        return None, 0
+    start = time.perf_counter()
+    page = _optimize_in_worker(fname, html, extract_text, serialize)
+    return page, time.perf_counter() - start
 
 
 class Downloader:
@@ -11,12 +67,27 @@ class Downloader:
         "https://wiki.archlinux.org/load.php?lang=en&modules=site.styles|skins.vector.icons,styles|zzz.ext.archLinux.styles&only=styles&skin=vector-2022": "ArchWikiOffline.css",
     }
 
+    # directory for the synchronization state, relative to the output directory
+    state_dirname = ".arch-wiki-docs"
+
     def __init__(
         self,
         api: API,
         output_directory: str,
         epoch: datetime.datetime,
         optimizer: Optimizer,
+        workers: int = 1,
+        max_per_host: int | None = None,
+        max_retries: int = 5,
+        optimizer_processes: int = 0,
+        metrics: Metrics | None = None,
+        search: bool = False,
+        referenced_images: bool = False,
+        converter=None,
+        write_html: bool = True,
+        offline: bool = False,
+        shard: Shard | None = None,
+        image_optimization: bool = False,
     ):
         """
         Parameters:
@@ -25,24 +96,136 @@ class Downloader:
         @epoch:             force update of every file older than this date (must be instance
                             of 'datetime')
         @optimizer:         Optimizer instance for HTML post-processing
+        @workers:           number of concurrent download threads (1 means sequential)
+        @max_per_host:      maximum number of concurrent connections to a single host
+                            (defaults to @workers)
+        @max_retries:       how many times to retry a request rejected with 429 or 503
+        @optimizer_processes: number of processes running the optimizer (0 means that
+                            pages are optimized in the download threads); to keep both
+                            the network and the CPUs busy, @workers should be larger than
+                            @optimizer_processes
+        @metrics:           Metrics instance collecting counters and stage timings
+                            (default: a verbose instance, printing each processed item)
+        @search:            maintain the offline full-text search index of the pages
+        @referenced_images: download only the images used on the downloaded pages
+                            instead of all images on the wiki
+        @converter:         ArchWiki.converter.Converter instance; if given, each page is
+                            converted right after optimization, using the same parsed tree
+                            (its input directory must be @output_directory)
+        @write_html:        store the optimized HTML pages; can be disabled only with
+                            @converter
+        @offline:           do not contact the wiki, the links are resolved using the
+                            site snapshot only (for reoptimize and the other operations
+                            working with the local state)
+        @shard:             synchronize only this slice of the pages and images, see
+                            merge_shards; the CSS is downloaded by the first shard
+                            (cannot be used with @search or @referenced_images)
+        @image_optimization: enable optimize_images, using @optimizer_processes
+                            processes (or all CPUs)
         """
 
         self.api = api
         self.output_directory = output_directory
         self.epoch = epoch
         self.optimizer = optimizer
+        self.workers = max(workers, 1)
+        self.max_per_host = max_per_host or self.workers
+        self.max_retries = max_retries
+        self.optimizer_processes = optimizer_processes
+        self.referenced_images = referenced_images
+        self.converter = converter
+        self.write_html = write_html or converter is None
+        self.offline = offline
+        self.shard = shard
+        if shard is not None and search:
+            raise ValueError("The search index can be maintained only after merging the shards")
+        if shard is not None and referenced_images:
+            # the shards would download the same images into a shared output directory
+            raise ValueError("Only all images can be downloaded by shards")
+        self.optimizer.link_index.offline = offline
+
+        # pooled session sharing headers and cookies with the API session
+        self.session = requests.Session()
+        self.session.headers.update(api.session.headers)
+        self.session.cookies = api.session.cookies
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.workers, pool_maxsize=self.workers
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.metrics = metrics or Metrics(verbose=True)
+
+        # state of the concurrent download mode
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._pending: set[concurrent.futures.Future] = set()
+        self._errors: list[BaseException] = []
+        self._slots = threading.BoundedSemaphore(2 * self.workers)
+        self._lock = threading.Lock()
+        self._host_limits: dict[str, threading.BoundedSemaphore] = {}
+
+        # pipeline stages: download threads -> optimizer processes -> writer thread
+        self._optimizer_pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self._write_queue: queue.Queue = queue.Queue(maxsize=2 * self.workers)
+        self._writer: threading.Thread | None = None
 
         # ensure output directory always exists
         if not os.path.isdir(self.output_directory):
             os.mkdir(self.output_directory)
 
-        # list of valid files
-        self.files = []
+        # state of the last synchronization, used by sync_incremental
+        self.state_directory = os.path.join(self.output_directory, self.state_dirname)
+        # shards sharing the output directory keep their own state
+        shard_directory = self.state_directory
+        if shard is not None:
+            shard_directory = os.path.join(self.state_directory, shard.name)
+        self.sync_state = SyncState(os.path.join(shard_directory, "sync.json"))
 
-    def needs_update(self, fname: str, timestamp: datetime.datetime) -> bool:
+        # namespaces and link index of the wiki, see load_link_index
+        self.snapshot = SiteSnapshot(os.path.join(shard_directory, "site.json.gz"))
+
+        # records of valid files
+        self.manifest = Manifest(
+            os.path.join(shard_directory, "manifest.sqlite"),
+            self.output_directory,
+        )
+
+        # validators of previous responses for conditional requests
+        self.cache = ResponseCache(os.path.join(self.state_directory, "http-cache"))
+
+        # unmodified HTML of the downloaded pages
+        self.raw_cache = RawCache(
+            os.path.join(self.state_directory, "raw"), self.output_directory
+        )
+
+        # full-text index of the pages, exported by update_search_index
+        self.search: SearchIndex | None = None
+        if search:
+            self.search = SearchIndex(
+                os.path.join(self.state_directory, "search.sqlite"), self.output_directory
+            )
+
+        # lossless recompression of the images, see optimize_images
+        self.image_optimizer: ImageOptimizer | None = None
+        if image_optimization:
+            self.image_optimizer = ImageOptimizer(
+                os.path.join(self.state_directory, "images.sqlite"), self.optimizer_processes
+            )
+        self.started = datetime.datetime.now(datetime.UTC)
+
+    def needs_update(
+        self, fname: str, timestamp: datetime.datetime, title: str | None = None
+    ) -> bool:
         """
-        Determine if it is necessary to download a page.
+        Determine if it is necessary to download a page. The manifest record
+        of @title is used if available, otherwise the mtime of the local file.
         """
+        if title is not None:
+            fresh = self.manifest.is_fresh(title, fname, timestamp, self.epoch)
+            if fresh is not None:
+                return not fresh
+
+        # fallback for files written before the manifest existed
         if not os.path.exists(fname):
             return True
         local = datetime.datetime.fromtimestamp(
@@ -52,11 +235,380 @@ class Downloader:
             return True
         return False
 
+    def page_needs_update(
+        self, fname: str, timestamp: datetime.datetime, title: str
+    ) -> bool:
+        """
+        needs_update() for pages, taking into account the output of the
+        converter in the pipeline mode.
+        """
+        if self.converter is not None:
+            outfile = self.converter.get_output_filename(fname)
+            if not all(os.path.exists(f) for f in self.converter.output_filenames(outfile)):
+                return True
+        if not self.write_html:
+            # there is no HTML file, rely on the manifest only
+            fresh = self.manifest.is_fresh(title, fname, timestamp, self.epoch, check_exists=False)
+            return fresh is not True
+        return self.needs_update(fname, timestamp, title)
+
+    def _host_limit(self, url: str) -> threading.BoundedSemaphore:
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.max_per_host
+                )
+            return self._host_limits[host]
+
+    @staticmethod
+    def _retry_delay(response: requests.Response, attempt: int) -> float:
+        """
+        Determine how long to wait before retrying a rejected request. The
+        'Retry-After' header (seconds or HTTP date) takes precedence, then the
+        replication lag reported by MediaWiki, then exponential backoff.
+        """
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            if retry_after.isdigit():
+                return float(retry_after)
+            try:
+                date = email.utils.parsedate_to_datetime(retry_after)
+                now = datetime.datetime.now(datetime.UTC)
+                return max((date - now).total_seconds(), 0)
+            except (TypeError, ValueError):
+                pass
+        lag = response.headers.get("X-Database-Lag")
+        if lag and lag.isdigit():
+            return float(lag)
+        return float(2**attempt)
+
+    def fetch(self, url: str, **kwargs) -> requests.Response:
+        """
+        GET the given URL through the pooled session. Requests rejected with
+        429 or 503 are retried after a delay, other errors are raised.
+        """
+        attempt = 0
+        while True:
+            with self._host_limit(url), self.metrics.timer("fetch"):
+                r = self.session.get(url, **kwargs)
+            if r.status_code in (429, 503) and attempt < self.max_retries:
+                r.close()
+                delay = self._retry_delay(r, attempt)
+                self.metrics.count("retries")
+                self.metrics.log(f"  [retrying]    {url} in {delay:.0f}s (HTTP {r.status_code})")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            r.raise_for_status()
+            if not kwargs.get("stream"):
+                self.metrics.count("bytes_downloaded", len(r.content))
+            return r
+
+    def _start_optimizer_pool(self) -> None:
+        """
+        Start the optimizer processes. This has to happen before any download
+        thread is started, because the workers are forked and inherit the
+        optimizer (including the API object and its caches) from the parent.
+        """
+        if self.optimizer is None:
+            return
+        # resolve the links once in the parent, the workers share the index
+        self.load_link_index()
+        if self.optimizer_processes < 1 or self._optimizer_pool is not None:
+            return
+        self._optimizer_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.optimizer_processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_optimizer_worker,
+            initargs=(self.optimizer, self.converter),
+        )
+        # the fork context launches all workers on the first submission
+        self._optimizer_pool.submit(int).result()
+
+    def _snapshot_config(self) -> dict:
+        """Options that affect the paths in the link index."""
+        return {
+            "langs": sorted(self.optimizer.langs),
+            "safe_filenames": self.optimizer.safe_filenames,
+        }
+
+    def load_link_index(self) -> None:
+        """
+        Make the link index complete: load it from the site snapshot and
+        update the entries of the pages changed on the wiki since the snapshot
+        was taken, or build it from scratch when there is no usable snapshot.
+        """
+        link_index = self.optimizer.link_index
+        if link_index.complete:
+            return
+        if self.snapshot.usable(self._snapshot_config(), self.started, self.offline):
+            print(f"Loading the link index from the site snapshot of {self.snapshot.timestamp}...")
+            with self.metrics.timer("link_index"):
+                link_index.load(self.snapshot.links)
+                if not self.offline:
+                    changes = recent_changes(
+                        self.api,
+                        self.snapshot.timestamp,
+                        self.started,
+                        link_index.namespaces,
+                        transclusions=False,
+                    )
+                    link_index.update(changes.pages)
+            return
+        if self.offline:
+            print("No usable site snapshot, links to other pages will not be updated")
+            return
+        print("Building the link index...")
+        with self.metrics.timer("link_index"):
+            link_index.build()
+
+    def namespaces(self) -> dict[int, dict]:
+        """Namespaces of the wiki, from the site snapshot if there is one."""
+        if self.snapshot.namespaces:
+            return self.snapshot.namespaces
+        return self.api.site.namespaces
+
+    def save_snapshot(self) -> None:
+        """
+        Save the namespaces and the link index for the next runs. Nothing is
+        saved in the offline mode or when the link index was not needed.
+        """
+        if self.offline or not self.optimizer.link_index.complete:
+            return
+        self.snapshot.save(
+            self.started,
+            self._snapshot_config(),
+            dict(self.api.site.namespaces),
+            self.optimizer.link_index.index,
+        )
+
+    def close(self) -> None:
+        """
+        Shut down the optimizer processes and close the manifest.
+        """
+        if self._optimizer_pool is not None:
+            self._optimizer_pool.shutdown()
+            self._optimizer_pool = None
+        self.manifest.close()
+        if self.search is not None:
+            self.search.close()
+        if self.image_optimizer is not None:
+            self.image_optimizer.close()
+
+    def optimize(self, fname: str, html: str) -> OptimizedPage:
+        if self.optimizer is None:
+            return OptimizedPage(html, set())
+        extract_text = self.search is not None
+        with self.metrics.timer("optimize"):
+            if self._optimizer_pool is not None:
+                # blocking here provides back-pressure towards the download threads
+                future = self._optimizer_pool.submit(
+                    _optimize_in_worker, fname, html, extract_text, self.write_html
+                )
+                page = future.result()
+                self.optimizer.link_index.index.update(page.links)
+                return page
+            return self.optimizer.optimize_page(
+                fname, html, extract_text, self.write_html, self.converter
+            )
+
+    def _writer_loop(self) -> None:
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            try:
+                self.store_page(*item)
+            except Exception as e:
+                self.metrics.count("errors")
+                with self._lock:
+                    self._errors.append(e)
+
+    def _count(self, written: bool) -> None:
+        self.metrics.count("files_written" if written else "files_unchanged")
+
+    def write_file(self, fname: str, data: bytes, content_hash: str) -> bool:
+        """
+        Replace the file atomically with @data, unless the file already has
+        the same content. Returns True if the file was written.
+        """
+        with self.metrics.timer("write"):
+            if os.path.exists(fname) and hash_file(fname) == content_hash:
+                return False
+
+            # ensure that target directory exists (necessary for subpages)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+            with atomic_open(fname, "wb") as fd:
+                fd.write(data)
+            return True
+
+    def store_page(
+        self,
+        title: str,
+        fname: str,
+        page: OptimizedPage,
+        timestamp: datetime.datetime,
+        revid: int | None,
+    ) -> None:
+        if page.convert_timings:
+            self.metrics.add_time("convert", sum(page.convert_timings.values()))
+            self.metrics.add_times(page.convert_timings, prefix="convert_")
+        if page.convert_error is not None:
+            self.metrics.print(f"{page.convert_error}\n  [conv failed] {title}")
+            self.metrics.count("errors")
+            # the outputs are outdated; while they are missing, page_needs_update
+            # processes the page again
+            for path in self.converter.output_filenames(self.converter.get_output_filename(fname)):
+                if os.path.exists(path):
+                    os.unlink(path)
+            if page.html is None:
+                # nothing was stored, the page is not recorded in the manifest
+                return
+        if page.converted_hash is not None:
+            self.metrics.count("pages_converted")
+        if page.html is None:
+            # only the converted page was stored, unchanged outputs are not rewritten
+            content_hash = page.converted_hash
+            record = self.manifest.get(title)
+            written = record is None or record["hash"] != content_hash
+        else:
+            data = page.html.encode("utf-8")
+            content_hash = hashlib.sha256(data).hexdigest()
+            written = self.write_file(fname, data, content_hash)
+        if not written:
+            self.metrics.log(f"  [unchanged]   {title}")
+        self._count(written)
+        self.manifest.mark_written(title, content_hash, timestamp, revid, changed=written)
+        self.manifest.set_references(title, page.images)
+        # unchanged pages were indexed before or will be by update_search_index
+        if written and self.search is not None and page.text is not None:
+            with self.metrics.timer("search"):
+                self.search.update(fname, page.heading, page.text)
+
+    def fetch_conditional(self, url: str, have_body: bool) -> requests.Response | None:
+        """
+        GET @url with the validators saved from the previous response. The
+        validators are sent only if @have_body, i.e. when the previous body
+        is still available locally. Returns None when the server replies with
+        '304 Not Modified'. The caller has to store the validators of the
+        response after saving its body.
+        """
+        headers = self.cache.validators(url) if have_body else {}
+        r = self.fetch(url, headers=headers)
+        if r.status_code == 304:
+            self.metrics.count("cache_hits")
+            return None
+        return r
+
+    def fetch_page(self, title: str, fname: str, url: str) -> str:
+        """
+        Return the HTML of a page, reusing the raw HTML cache if the page was
+        not modified on the server.
+        """
+        r = self.fetch_conditional(url, self.raw_cache.exists(fname))
+        if r is None:
+            html = self.raw_cache.load(fname)
+            if html is not None:
+                self.metrics.log(f"  [not modified] {title}")
+                return html
+            # the cached body disappeared in the meantime
+            r = self.fetch(url)
+        self.raw_cache.save(fname, r.text)
+        # the validators match the cached body only now
+        self.cache.store(url, r)
+        return r.text
+
+    def _submit(self, fn, *args) -> None:
+        """
+        Run a download task. In the concurrent mode the task is queued to the
+        thread pool; at most 2*workers tasks are in flight, so the enumeration
+        blocks instead of buffering the whole wiki.
+        """
+        if self.workers == 1:
+            fn(*args)
+            return
+        if self._errors:
+            self._wait()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers
+            )
+            self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer.start()
+        self._slots.acquire()
+        future = self._executor.submit(fn, *args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._task_done)
+
+    def _task_done(self, future: concurrent.futures.Future) -> None:
+        failed = not future.cancelled() and future.exception() is not None
+        with self._lock:
+            self._pending.discard(future)
+            if failed:
+                self._errors.append(future.exception())
+        if failed:
+            self.metrics.count("errors")
+        self._slots.release()
+
+    def _commit(self) -> None:
+        self.manifest.commit()
+        if self.search is not None:
+            self.search.commit()
+
+    def _wait(self) -> None:
+        """
+        Wait for all queued download tasks and re-raise the first error.
+        """
+        if self._executor is None:
+            self._commit()
+            return
+        try:
+            with self._lock:
+                pending = list(self._pending)
+            if self._errors:
+                for future in pending:
+                    future.cancel()
+            concurrent.futures.wait(pending)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            assert self._writer is not None
+            self._write_queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._commit()
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def download_page(
+        self,
+        title: str,
+        fname: str,
+        url: str,
+        timestamp: datetime.datetime,
+        revid: int | None = None,
+    ) -> None:
+        self.metrics.log(f"  [downloading] {title}")
+        self.metrics.count("pages_downloaded")
+        html = self.fetch_page(title, fname, url)
+        page = self.optimize(fname, html)
+        item = (title, fname, page, timestamp, revid)
+        if self._writer is not None:
+            self._write_queue.put(item)
+        else:
+            self.store_page(*item)
+
     def process_namespace(self, namespace: str) -> None:
         """
         Enumerate all pages in given namespace, download if necessary
         """
         print(f"Processing namespace {namespace}...")
+        self._start_optimizer_pool()
 
         allpages = self.api.generator(
             generator="allpages",
@@ -66,85 +618,502 @@ class Downloader:
             prop="info",
             inprop="url",
         )
-        for page in allpages:
+        for page in self.metrics.timed_iter(allpages, "enumerate"):
             title = page["title"]
+            if self.shard is not None and title not in self.shard:
+                continue
             fname = self.optimizer.get_local_filename(title, self.output_directory)
             if not fname:
-                print(f"  [skipping] {title}")
+                self.metrics.log(f"  [skipping] {title}")
+                self.metrics.count("skipped")
                 continue
-            self.files.append(fname)
+            self.manifest.mark_seen(title, fname, "page")
             timestamp = page["touched"]
-            if self.needs_update(fname, timestamp):
-                print(f"  [downloading] {title}")
-                fullurl = page["fullurl"]
-
-                r = self.api.session.get(fullurl)
-                r.raise_for_status()
-                if self.optimizer is not None:
-                    text = self.optimizer.optimize(fname, r.text)
-                else:
-                    text = r.text
-
-                # ensure that target directory exists (necessary for subpages)
-                os.makedirs(os.path.dirname(fname), exist_ok=True)
-
-                with open(fname, "w") as fd:
-                    fd.write(text)
+            if self.page_needs_update(fname, timestamp, title):
+                self._submit(
+                    self.download_page,
+                    title,
+                    fname,
+                    page["fullurl"],
+                    timestamp,
+                    page.get("lastrevid"),
+                )
+            else:
+                self.metrics.log(f"  [up-to-date]  {title}")
+                self.metrics.count("up_to_date")
+        self._wait()
+        self.metrics.end_progress()
+
+    def _sync_config(self) -> dict:
+        """Options that affect the set of files on the output."""
+        return {
+            "langs": sorted(self.optimizer.langs),
+            "safe_filenames": self.optimizer.safe_filenames,
+            "referenced_images": self.referenced_images,
+            "write_html": self.write_html,
+        }
+
+    def save_sync_state(self) -> None:
+        """
+        Record the start of this run as the last synchronization. Should be
+        called only after all pages and images have been processed.
+        """
+        self.sync_state.save(self.started, self._sync_config())
+
+    def _remove_stale(self, title: str, fname: str, clean: bool) -> None:
+        self.manifest.remove(title)
+        self.raw_cache.remove(fname)
+        if not clean:
+            return
+        paths = [fname]
+        if self.converter is not None and fname.endswith(".html"):
+            paths += self.converter.output_filenames(self.converter.get_output_filename(fname))
+        for path in paths:
+            if os.path.exists(path):
+                self.metrics.log(f"  [deleting]    {path}")
+                self.metrics.count("files_deleted")
+                os.unlink(path)
+
+    def sync_incremental(self, namespaces: list[str], clean: bool = False) -> bool:
+        """
+        Download only the pages and images changed on the wiki since the last
+        synchronization. With @clean, files of pages deleted, moved or turned
+        into redirects are deleted as well.
+
+        Returns False when the saved state is missing, too old or made with a
+        different configuration; a full scan is necessary in that case.
+        """
+        if not self.sync_state.usable(self._sync_config(), self.epoch, self.started):
+            print("Incremental sync is not possible, doing a full scan...")
+            return False
+
+        print(f"Fetching changes since {self.sync_state.timestamp}...")
+        with self.metrics.timer("enumerate"):
+            changes = recent_changes(
+                self.api, self.sync_state.timestamp, self.started, namespaces
+            )
+        if self.shard is not None:
+            changes.pages = {title for title in changes.pages if title in self.shard}
+            changes.images = {title for title in changes.images if title in self.shard}
+        print(f"  {len(changes.pages)} pages and {len(changes.images)} images changed")
+
+        print("Processing changed pages...")
+        self._start_optimizer_pool()
+        pages = query_titles(self.api, sorted(changes.pages), prop="info", inprop="url")
+        for page in self.metrics.timed_iter(pages, "enumerate"):
+            title = page["title"]
+            fname = self.optimizer.get_local_filename(title, self.output_directory)
+            if not fname:
+                self.metrics.log(f"  [skipping] {title}")
+                self.metrics.count("skipped")
+                continue
+            if "missing" in page or "redirect" in page or str(page["ns"]) not in namespaces:
+                self._remove_stale(title, fname, clean)
+                continue
+            self.manifest.mark_seen(title, fname, "page")
+            timestamp = parse_timestamp(page["touched"])
+            if self.page_needs_update(fname, timestamp, title):
+                self._submit(
+                    self.download_page,
+                    title,
+                    fname,
+                    page["fullurl"],
+                    timestamp,
+                    page.get("lastrevid"),
+                )
             else:
-                print(f"  [up-to-date]  {title}")
+                self.metrics.log(f"  [up-to-date]  {title}")
+                self.metrics.count("up_to_date")
+        self._wait()
+        self.metrics.end_progress()
+
+        print("Processing changed images...")
+        titles = changes.images
+        if self.referenced_images:
+            self._collect_missing_references()
+            referenced = self.manifest.references()
+            known = {title for title, *_ in self.manifest.files("image")}
+            # images no longer used on any page
+            for title in sorted(known - referenced):
+                fname = self.optimizer.get_local_filename(title, self.output_directory)
+                if fname:
+                    self._remove_stale(title, fname, clean)
+            # changed images and images newly used on the changed pages
+            titles = (titles & referenced) | (referenced - known)
+        self._process_images(titles, clean)
+
+        return True
+
+    def _process_images(self, titles: set[str], clean: bool) -> None:
+        """
+        Download the given images if necessary. Images which no longer exist
+        are removed from the manifest (and with @clean also from the disk).
+        """
+        images = query_titles(self.api, sorted(titles), prop="imageinfo", iiprop="url|timestamp")
+        for image in self.metrics.timed_iter(images, "enumerate"):
+            title = image["title"]
+            fname = self.optimizer.get_local_filename(title, self.output_directory)
+            if not fname:
+                self.metrics.log(f"  [skipping] {title}")
+                self.metrics.count("skipped")
+                continue
+            if not image.get("imageinfo"):
+                self._remove_stale(title, fname, clean)
+                continue
+            self.manifest.mark_seen(title, fname, "image")
+            info = image["imageinfo"][0]
+            timestamp = parse_timestamp(info["timestamp"])
+            if self.needs_update(fname, timestamp, title):
+                self._submit(self.download_image, title, fname, info["url"], timestamp)
+            else:
+                self.metrics.log(f"  [up-to-date]  {title}")
+                self.metrics.count("up_to_date")
+        self._wait()
+        self.metrics.end_progress()
+
+    def reoptimize(self) -> None:
+        """
+        Regenerate all optimized pages from the raw HTML cache, without
+        downloading anything. Uses all CPUs unless the number of optimizer
+        processes was set explicitly. The links are resolved from the site
+        snapshot without contacting the wiki, if there is a usable one.
+        """
+        print("Re-optimizing pages from the raw HTML cache...")
+        # the pages are as old as the snapshot, there is nothing to revalidate
+        if self.optimizer is not None and self.snapshot.usable(self._snapshot_config(), self.started, offline=True):
+            self.offline = self.optimizer.link_index.offline = True
+        if self.optimizer_processes < 1:
+            self.optimizer_processes = os.cpu_count() or 1
+        self._start_optimizer_pool()
+        assert self._optimizer_pool is not None
+
+        pending: dict[concurrent.futures.Future, tuple] = {}
+
+        def collect(return_when: str) -> None:
+            done, _ = concurrent.futures.wait(pending, return_when=return_when)
+            for future in done:
+                title, fname, timestamp, revid = pending.pop(future)
+                page, seconds = future.result()
+                if page is None:
+                    self.metrics.log(f"  [not cached]  {title}")
+                    self.metrics.count("not_cached")
+                    continue
+                self.optimizer.link_index.index.update(page.links)
+                self.metrics.log(f"  [optimized]   {title}")
+                self.metrics.add_time("optimize", seconds)
+                self.metrics.count("pages_optimized")
+                self.store_page(title, fname, page, timestamp, revid)
+
+        for title, fname, timestamp, revid in self.manifest.files("page"):
+            # keep at most 2 tasks per process in flight
+            if len(pending) >= 2 * self.optimizer_processes:
+                collect(concurrent.futures.FIRST_COMPLETED)
+            future = self._optimizer_pool.submit(
+                _reoptimize_in_worker,
+                self.raw_cache,
+                fname,
+                self.search is not None,
+                self.write_html,
+            )
+            pending[future] = (title, fname, timestamp, revid)
+        collect(concurrent.futures.ALL_COMPLETED)
+        self._commit()
+        self.metrics.end_progress()
 
     def download_css(self) -> None:
+        if self.shard is not None and self.shard.index != 0:
+            return
         print("Downloading CSS...")
         for link, dest in self.css_links.items():
-            print(" ", dest)
+            self.metrics.log(f"  {dest}")
             fname = os.path.join(self.output_directory, dest)
             if fname:
-                self.files.append(fname)
-                r = self.api.session.get(link)
-                r.raise_for_status()
-                with open(fname, "w") as fd:
-                    fd.write(r.text)
+                self.manifest.mark_seen(link, fname, "css")
+                r = self.fetch(link)
+                data = r.text.encode("utf-8")
+                content_hash = hashlib.sha256(data).hexdigest()
+                written = self.write_file(fname, data, content_hash)
+                self._count(written)
+                self.manifest.mark_written(link, content_hash, self.started, changed=written)
+        self.manifest.commit()
+        self.metrics.end_progress()
 
     def download_images(self) -> None:
+        if self.referenced_images:
+            self.download_referenced_images()
+            return
         print("Downloading images...")
         allimages = self.api.list(
             list="allimages", ailimit="max", aiprop="url|timestamp"
         )
-        for image in allimages:
+        for image in self.metrics.timed_iter(allimages, "enumerate"):
             title = image["title"]
+            if self.shard is not None and title not in self.shard:
+                continue
             fname = self.optimizer.get_local_filename(title, self.output_directory)
             if not fname:
-                print(f"  [skipping] {title}")
+                self.metrics.log(f"  [skipping] {title}")
+                self.metrics.count("skipped")
                 continue
-            self.files.append(fname)
+            self.manifest.mark_seen(title, fname, "image")
             timestamp = image["timestamp"]
-            if self.needs_update(fname, timestamp):
-                print(f"  [downloading] {title}")
-                r = self.api.session.get(image["url"])
-                r.raise_for_status()
-                with open(fname, "wb") as fd:
-                    fd.write(r.content)
+            if self.needs_update(fname, timestamp, title):
+                self._submit(self.download_image, title, fname, image["url"], timestamp)
+            else:
+                self.metrics.log(f"  [up-to-date]  {title}")
+                self.metrics.count("up_to_date")
+        self._wait()
+        self.metrics.end_progress()
+
+    def _collect_missing_references(self) -> None:
+        """
+        Record the images used on pages which were downloaded without
+        recording them, using the raw HTML cache.
+        """
+        for title, fname in self.manifest.pages_without_references():
+            html = self.raw_cache.load(fname)
+            if html is not None:
+                self.manifest.set_references(title, self.optimizer.collect_images(html))
+
+    def download_referenced_images(self) -> None:
+        """
+        Download the images used on the downloaded pages, as collected by the
+        optimizer. Must be run after all pages are processed; images which
+        are not referenced are not marked as seen, so they are removed from
+        the manifest by prune_manifest (and deleted by --clean). With a shard,
+        these are the images used on the pages of the shard, regardless of
+        the shard of the image.
+        """
+        print("Downloading images used on the pages...")
+        self._collect_missing_references()
+        self._process_images(self.manifest.references(), clean=False)
+
+    def download_image(
+        self, title: str, fname: str, url: str, timestamp: datetime.datetime
+    ) -> None:
+        """
+        Download an image into a temporary '.part' file and rename it into
+        place when complete. An incomplete '.part' file left by an earlier
+        run is resumed with a Range request. Identical images are hardlinked
+        instead of stored repeatedly.
+        """
+        self.metrics.log(f"  [downloading] {title}")
+        self.metrics.count("images_downloaded")
+        part = fname + ".part"
+        # the output file itself serves as the cached body
+        have_body = os.path.exists(fname)
+        headers = self.cache.validators(url) if have_body else {}
+
+        offset = 0
+        if not have_body and os.path.exists(part):
+            offset = os.path.getsize(part)
+            # resume only if the server still has the same version of the file
+            validators = self.cache.validators(url, partial=True)
+            validator = validators.get("If-None-Match") or validators.get("If-Modified-Since")
+            if offset > 0 and validator:
+                headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+            else:
+                offset = 0
+
+        try:
+            r = self.fetch(url, headers=headers, stream=True)
+        except requests.HTTPError as e:
+            if offset > 0 and e.response is not None and e.response.status_code == 416:
+                # the partial file does not match, start over
+                os.unlink(part)
+                return self.download_image(title, fname, url, timestamp)
+            raise
+
+        with r:
+            if r.status_code == 304:
+                self.metrics.log(f"  [not modified] {title}")
+                self.metrics.count("cache_hits")
+                self._count(False)
+                self.manifest.mark_written(title, hash_file(fname), timestamp, changed=False)
+                return
+
+            # validators of the partial file, see ResponseCache
+            self.cache.store(url, r, partial=True)
+            h = hashlib.sha256()
+            if r.status_code == 206:
+                self.metrics.log(f"  [resuming]    {title} at {offset} bytes")
+                self.metrics.count("images_resumed")
+                with open(part, "rb") as fd:
+                    for chunk in iter(lambda: fd.read(65536), b""):
+                        h.update(chunk)
+                mode = "ab"
             else:
-                print(f"  [up-to-date]  {title}")
+                mode = "wb"
+            with open(part, mode) as fd, self.metrics.timer("fetch"):
+                for chunk in r.iter_content(chunk_size=65536):
+                    h.update(chunk)
+                    fd.write(chunk)
+                    self.metrics.count("bytes_downloaded", len(chunk))
+
+        content_hash = h.hexdigest()
+        with self.metrics.timer("write"):
+            written = self._store_image(title, fname, part, content_hash)
+        # the complete file is in place, its validators can be used
+        self.cache.store(url, r)
+        self.cache.discard(url, partial=True)
+        self._count(written)
+        self.manifest.mark_written(title, content_hash, timestamp, changed=written)
+
+    def _store_image(self, title: str, fname: str, part: str, content_hash: str) -> bool:
+        """
+        Move a complete download into place. If an image with identical
+        content already exists, it is hardlinked instead. Returns False if
+        the file already had the same content.
+        """
+        if os.path.exists(fname) and hash_file(fname) == content_hash:
+            self.metrics.log(f"  [unchanged]   {title}")
+            os.unlink(part)
+            return False
+        for other in self.manifest.find_by_hash(content_hash, "image"):
+            if other == fname or not os.path.isfile(other):
+                continue
+            try:
+                if hash_file(other) != content_hash:
+                    continue
+                link = fname + ".link"
+                os.link(other, link)
+            except OSError:
+                continue
+            self.metrics.log(f"  [deduplicated] {title} -> {other}")
+            self.metrics.count("images_deduplicated")
+            os.replace(link, fname)
+            os.unlink(part)
+            return True
+        os.replace(part, fname)
+        return True
+
+    def optimize_images(self) -> None:
+        """
+        Recompress the images in the manifest losslessly, replacing the files
+        in place. Images processed by earlier runs are skipped, unless their
+        content changed.
+        """
+        assert self.image_optimizer is not None
+        print("Optimizing images...")
+        with self.metrics.timer("optimize_images"):
+            count, saved = self.image_optimizer.optimize(self.manifest, self.metrics)
+        self.metrics.end_progress()
+        print(f"  {count} images optimized, {saved / 2**20:.1f} MiB saved")
+
+    def prune_manifest(self) -> None:
+        """
+        Forget files which were not enumerated in this run, i.e. deleted or
+        moved on the wiki. Should be run only after a full scan.
+        """
+        count = self.manifest.prune()
+        print(f"Removed {count} deleted/moved files from the manifest")
+
+    def report_changes(self) -> None:
+        changed = self.manifest.changed()
+        counters = self.metrics.counters
+        print(f"{len(changed)} files changed in this run")
+        print(f"  {counters['files_written']} files written, {counters['files_unchanged']} unchanged")
+
+    def update_search_index(self) -> None:
+        """
+        Bring the search index in sync with the pages in the manifest and
+        export the changed parts. Pages which were not indexed when they were
+        optimized (e.g. downloaded before the index was enabled) are indexed
+        from the files in the output directory.
+        """
+        assert self.search is not None
+        print("Updating the search index...")
+        pages = {fname for title, fname, timestamp, revid in self.manifest.files("page")}
+        with self.metrics.timer("search"):
+            removed = self.search.retain(pages)
+            missing = sorted(pages - self.search.paths())
+            for fname in missing:
+                if os.path.isfile(fname):
+                    self.search.update(fname, *self.optimizer.extract_text_from_file(fname))
+            count = self.search.write()
+        print(f"  {len(missing)} pages indexed, {removed} removed, {count} index files updated")
+
+    def write_pack(self, path: str) -> None:
+        """
+        Pack all pages, images and stylesheets recorded in the manifest into
+        a single archive (see ArchWiki.pack). Titles of pages and images are
+        indexed, so that they can be looked up without the manifest.
+        """
+        print(f"Packing the output directory into {path}...")
+        files: list[tuple[str | None, str]] = []
+        for kind in ("page", "image", "css"):
+            for title, fname, timestamp, revid in self.manifest.files(kind):
+                if os.path.isfile(fname):
+                    files.append((None if kind == "css" else title, fname))
+        if self.search is not None:
+            for dirpath, dirnames, filenames in os.walk(self.search.directory):
+                files.extend((None, os.path.join(dirpath, f)) for f in filenames)
+        with self.metrics.timer("pack"):
+            count = write_pack(path, self.output_directory, files)
+        size = os.path.getsize(path)
+        print(f"  {count} files packed, {size / 2**20:.1f} MiB")
+
+    def merge_shards(self, count: int) -> None:
+        """
+        Combine the manifests of all @count shards into the manifest of the
+        output directory. Afterwards it lists exactly the files synced by the
+        shards, so clean_output_directory, update_search_index and write_pack
+        work on the whole mirror. The shards must have been synced into this
+        output directory, or their output directories (including the state
+        directories) copied into it.
+        """
+        assert self.shard is None
+        print(f"Merging the manifests of {count} shards...")
+        for i in range(count):
+            path = os.path.join(self.state_directory, Shard(i, count).name, "manifest.sqlite")
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"Manifest of shard {i}/{count} not found: {path}")
+            merged = self.manifest.merge(path)
+            print(f"  {merged} files from shard {i}/{count}")
+        # forget files of previous unsharded runs
+        self.prune_manifest()
 
     def clean_output_directory(self) -> None:
         """
-        Walk output_directory and delete all files not found on the wiki.
+        Walk output_directory (and the output directories of the converter)
+        and delete all files not found on the wiki.
         Should be run _after_ downloading, otherwise all files will be deleted!
         """
 
         print("Deleting unwanted files (deleted/moved on the wiki)...")
-        valid_files = self.files.copy()
-
-        for path, dirs, files in os.walk(self.output_directory, topdown=False):
-            # handle files
-            for f in files:
-                fpath = os.path.join(path, f)
-                if fpath not in valid_files:
-                    print(f"  [deleting]    {fpath}")
-                    os.unlink(fpath)
-
-            # remove empty directories
-            if len(os.listdir(path)) == 0:
-                print(f"  [deleting]    {path}/")
-                os.rmdir(path)
+        valid_files = self.manifest.paths()
+        directories = [self.output_directory]
+        if self.converter is not None:
+            # outputs of the converter in the pipeline mode
+            for fname in list(valid_files):
+                if fname.endswith(".html"):
+                    valid_files.update(self.converter.output_filenames(self.converter.get_output_filename(fname)))
+            for directory in self.converter.output_directories():
+                valid_files.add(os.path.join(directory, self.converter.manifest_name))
+                if os.path.commonpath([directory, self.output_directory]) != self.output_directory:
+                    directories.append(directory)
+        search_directory = os.path.join(self.output_directory, SearchIndex.dirname)
+
+        for directory in directories:
+            for path, dirs, files in os.walk(directory, topdown=False):
+                # keep the synchronization state and the search index (also when
+                # it is not updated by this run, it is exported incrementally)
+                if os.path.commonpath([path, self.state_directory]) == self.state_directory:
+                    continue
+                if os.path.commonpath([path, search_directory]) == search_directory:
+                    continue
+
+                # handle files
+                for f in files:
+                    fpath = os.path.join(path, f)
+                    if fpath not in valid_files:
+                        self.metrics.log(f"  [deleting]    {fpath}")
+                        self.metrics.count("files_deleted")
+                        os.unlink(fpath)
+
+                # remove empty directories
+                if len(os.listdir(path)) == 0:
+                    self.metrics.log(f"  [deleting]    {path}/")
+                    os.rmdir(path)
+
+        self.metrics.end_progress()
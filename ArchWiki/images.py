@@ -0,0 +1,313 @@
+import concurrent.futures
+import itertools
+import os
+import shutil
+import sqlite3
+import subprocess
+
+import lxml.etree
+
+from .atomic import atomic_path
+from .manifest import Manifest, hash_file
+from .metrics import Metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    source TEXT NOT NULL,
+    method TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (source, method)
+);
+CREATE INDEX IF NOT EXISTS results_result ON results(result, method);
+CREATE TABLE IF NOT EXISTS files (
+    title TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+# namespaces of editor data, which does not affect the rendering
+EDITOR_NAMESPACES = frozenset([
+    "http://www.inkscape.org/namespaces/inkscape",
+    "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd",
+])
+# elements whose whitespace is significant
+TEXT_ELEMENTS = frozenset(f"{{{SVG_NAMESPACE}}}{tag}" for tag in ["text", "tspan", "textPath", "title", "desc", "style", "script"])
+
+# version of minify_svg, to be increased when it can produce smaller output
+SVG_METHOD = "svg-1"
+
+
+def minify_svg(data: bytes) -> bytes:
+    """
+    Minify an SVG image without changing its rendering: remove comments,
+    metadata, editor data and whitespace between elements.
+    """
+    parser = lxml.etree.XMLParser(remove_comments=True, resolve_entities=False, huge_tree=True)
+    root = lxml.etree.fromstring(data, parser)
+
+    # metadata and editor elements (e.g. sodipodi:namedview) are not rendered
+    for elem in list(root.iter(lxml.etree.Element)):
+        parent = elem.getparent()
+        if parent is None:
+            continue
+        if elem.tag == f"{{{SVG_NAMESPACE}}}metadata" or lxml.etree.QName(elem).namespace in EDITOR_NAMESPACES:
+            parent.remove(elem)
+    for elem in root.iter(lxml.etree.Element):
+        for name in list(elem.attrib):
+            if lxml.etree.QName(name).namespace in EDITOR_NAMESPACES:
+                del elem.attrib[name]
+
+    xml_space = "{http://www.w3.org/XML/1998/namespace}space"
+    for elem in root.iter(lxml.etree.Element):
+        if any(
+            e.tag in TEXT_ELEMENTS or e.get(xml_space) == "preserve"
+            for e in itertools.chain([elem], elem.iterancestors())
+        ):
+            continue
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        for child in elem:
+            if child.tail is not None and not child.tail.strip():
+                child.tail = None
+
+    lxml.etree.cleanup_namespaces(root)
+    # the tree includes the doctype, which may declare entities
+    return lxml.etree.tostring(root.getroottree(), xml_declaration=True, encoding="utf-8")
+
+
+def _optimize_image(fname: str, command: list[str] | None) -> tuple[int, int] | None:
+    """
+    Recompress @fname with @command (or minify it, for None) and replace it
+    if the result is smaller. Returns the original and the new size, or None
+    if the optimization failed.
+    """
+    size = os.path.getsize(fname)
+    try:
+        with atomic_path(fname, ".opt") as tmp:
+            if command is None:
+                with open(fname, "rb") as fd:
+                    data = minify_svg(fd.read())
+                with open(tmp, "wb") as fd:
+                    fd.write(data)
+            else:
+                args = [{"{input}": fname, "{output}": tmp}.get(arg, arg) for arg in command]
+                subprocess.run(
+                    args,
+                    check=True,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=300,
+                )
+            new_size = os.path.getsize(tmp)
+            if not 0 < new_size < size:
+                # keep the original
+                os.unlink(tmp)
+                return size, size
+            shutil.copystat(fname, tmp)
+        return size, new_size
+    except (OSError, ValueError, subprocess.SubprocessError, lxml.etree.XMLSyntaxError):
+        return None
+
+
+def _inode(fname: str) -> tuple[int, int]:
+    st = os.stat(fname)
+    return st.st_dev, st.st_ino
+
+
+def _replace_with_link(source: str, fname: str) -> None:
+    """Replace @fname with a hardlink to @source, or a copy if hardlinks are not supported."""
+    with atomic_path(fname, ".link") as link:
+        try:
+            os.link(source, link)
+        except OSError:
+            shutil.copy2(source, link)
+
+
+class ImageOptimizer:
+    """
+    Lossless recompression of the downloaded images in a process pool. PNG
+    and JPEG images are recompressed by external tools, if available, and
+    SVG images are minified. The files are replaced in place, so the paths
+    (and thus the links created by Optimizer.update_links) stay the same,
+    and their hashes are updated in the manifest.
+
+    An SQLite database maps the hashes of the processed images to the hashes
+    of the results, so an image downloaded again with the original content
+    is replaced by an existing optimized copy instead of being processed
+    again. It also stores the mtime and size of each file after processing,
+    so unchanged files are skipped without reading them.
+    """
+
+    # lossless recompressors in the order of preference, the first installed one is used
+    tools = {
+        ".png": [
+            ["oxipng", "--quiet", "--opt", "2", "--strip", "safe", "--out", "{output}", "{input}"],
+            ["optipng", "-quiet", "-o2", "-out", "{output}", "{input}"],
+        ],
+        ".jpg": [
+            ["jpegtran", "-copy", "all", "-optimize", "-progressive", "-outfile", "{output}", "{input}"],
+        ],
+    }
+    tools[".jpeg"] = tools[".jpg"]
+
+    def __init__(self, path: str, processes: int = 0):
+        """
+        @path:      path to the database file
+        @processes: number of worker processes (0 means the number of CPUs)
+        """
+        self.path = path
+        self.processes = processes or os.cpu_count() or 1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+        # extension -> (method, command or None)
+        self.methods: dict[str, tuple[str, list[str] | None]] = {".svg": (SVG_METHOD, None)}
+        for ext, commands in self.tools.items():
+            for command in commands:
+                if shutil.which(command[0]):
+                    self.methods[ext] = (command[0], command)
+                    break
+
+    def _result(self, content_hash: str, method: str) -> str | None:
+        """Hash of the result of processing @content_hash, if it was already done."""
+        row = self._db.execute(
+            "SELECT result FROM results WHERE source = ? AND method = ?", (content_hash, method)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        # the content is itself a result, there is nothing more to do
+        row = self._db.execute(
+            "SELECT 1 FROM results WHERE result = ? AND method = ?", (content_hash, method)
+        ).fetchone()
+        return content_hash if row is not None else None
+
+    def _mark_done(self, content_hash: str, method: str, result: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO results (source, method, result) VALUES (?, ?, ?)",
+            (content_hash, method, result),
+        )
+
+    def _is_unchanged(self, title: str, fname: str, content_hash: str) -> bool:
+        """Check if the file was not touched since it was processed."""
+        row = self._db.execute(
+            "SELECT hash, mtime, size FROM files WHERE title = ?", (title,)
+        ).fetchone()
+        if row is None:
+            return False
+        st = os.stat(fname)
+        return tuple(row) == (content_hash, st.st_mtime_ns, st.st_size)
+
+    def _record(self, manifest: Manifest, title: str, fname: str, content_hash: str) -> None:
+        """Record the processed file, also in the manifest."""
+        manifest.set_hash(title, content_hash)
+        st = os.stat(fname)
+        self._db.execute(
+            "INSERT OR REPLACE INTO files (title, hash, mtime, size) VALUES (?, ?, ?, ?)",
+            (title, content_hash, st.st_mtime_ns, st.st_size),
+        )
+
+    def _link_result(self, manifest: Manifest, fname: str, result: str) -> bool:
+        """Replace @fname with an existing file with the content @result."""
+        for other in manifest.find_by_hash(result, "image"):
+            if other == fname or not os.path.isfile(other):
+                continue
+            try:
+                if hash_file(other) != result:
+                    continue
+                _replace_with_link(other, fname)
+            except OSError:
+                continue
+            return True
+        return False
+
+    def optimize(self, manifest: Manifest, metrics: Metrics) -> tuple[int, int]:
+        """
+        Optimize the images in @manifest which were not processed yet.
+        Identical images are processed once and hardlinked to the result.
+        Returns the number of optimized images and the number of bytes saved
+        on the disk, where hardlinked files are counted once.
+        """
+        # (hash, method) -> titles and paths of the files with this content
+        groups: dict[tuple[str, str], list[tuple[str, str]]] = {}
+        commands: dict[str, list[str] | None] = {}
+        # inodes of the files replaced by a link to a known result
+        relinked: set[tuple[int, int]] = set()
+        count = 0
+        saved = 0
+        for title, fname, manifest_hash in manifest.hashes("image"):
+            ext = os.path.splitext(fname)[1].lower()
+            if ext not in self.methods or not os.path.isfile(fname):
+                continue
+            method, command = self.methods[ext]
+            if self._is_unchanged(title, fname, manifest_hash):
+                continue
+            content_hash = hash_file(fname)
+            result = self._result(content_hash, method)
+            if result is not None and result != content_hash:
+                size = os.path.getsize(fname)
+                inode = _inode(fname)
+                if self._link_result(manifest, fname, result):
+                    new_size = os.path.getsize(fname)
+                    metrics.log(f"  [optimized]   {fname}: {size} -> {new_size} bytes (known result)")
+                    count += 1
+                    metrics.count("images_optimized")
+                    # the result exists already, the whole original is freed
+                    if inode not in relinked:
+                        relinked.add(inode)
+                        saved += size
+                        metrics.count("image_bytes_saved", size)
+                    content_hash = result
+                else:
+                    result = None
+            if result is not None:
+                self._record(manifest, title, fname, content_hash)
+                continue
+            groups.setdefault((content_hash, method), []).append((title, fname))
+            commands[method] = command
+
+        if not groups:
+            self._db.commit()
+            return count, saved
+        # number of distinct copies of each content on the disk
+        copies = {key: len({_inode(fname) for title, fname in files}) for key, files in groups.items()}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as pool:
+            futures = {
+                pool.submit(_optimize_image, files[0][1], commands[method]): (content_hash, method)
+                for (content_hash, method), files in groups.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                content_hash, method = futures[future]
+                files = groups[content_hash, method]
+                first = files[0][1]
+                result = future.result()
+                if result is None:
+                    metrics.log(f"  [failed]      {first}")
+                    continue
+                size, new_size = result
+                new_hash = content_hash
+                if new_size < size:
+                    for title, fname in files[1:]:
+                        _replace_with_link(first, fname)
+                    metrics.log(f"  [optimized]   {first}: {size} -> {new_size} bytes")
+                    count += len(files)
+                    # all copies are replaced by links to one optimized file
+                    group_saved = copies[content_hash, method] * size - new_size
+                    saved += group_saved
+                    metrics.count("images_optimized", len(files))
+                    metrics.count("image_bytes_saved", group_saved)
+                    new_hash = hash_file(first)
+                self._mark_done(content_hash, method, new_hash)
+                for title, fname in files:
+                    self._record(manifest, title, fname, new_hash)
+        self._db.commit()
+        manifest.commit()
+        return count, saved
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
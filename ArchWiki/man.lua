@@ -0,0 +1,9 @@
+-- pandoc Lua filter equivalent to ManFilter.filter_in
+
+-- remove the .html suffix from links between the converted pages
+function Link(el)
+  if el.target:sub(-5) == ".html" then
+    el.target = el.target:sub(1, -6)
+  end
+  return el
+end
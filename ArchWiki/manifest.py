@@ -0,0 +1,290 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from .sync import format_timestamp, parse_timestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    title TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    revid INTEGER,
+    touched TEXT,
+    hash TEXT,
+    synced TEXT,
+    seen INTEGER,
+    changed INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_path ON files(path);
+CREATE INDEX IF NOT EXISTS files_changed ON files(changed);
+CREATE INDEX IF NOT EXISTS files_hash ON files(hash);
+CREATE TABLE IF NOT EXISTS refs (
+    page TEXT PRIMARY KEY,
+    images TEXT NOT NULL
+);
+"""
+
+
+def hash_file(path: str) -> str:
+    """Return the SHA-256 hash of a file, as stored in the manifest."""
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    SQLite database of all files in the output directory. Each record is keyed
+    by the title (or URL for files without a title) and stores the revision
+    id and timestamp of the downloaded content, the path relative to the
+    output directory and the SHA-256 hash of the content.
+
+    Every instance represents one run: files enumerated on the wiki are marked
+    as seen in the run and files written to the disk as changed in the run.
+    """
+
+    def __init__(self, path: str, base_directory: str):
+        """
+        @path:           path to the database file
+        @base_directory: output directory, paths are stored relative to it
+        """
+        self.path = path
+        self.base_directory = base_directory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # the connection is shared by the download and writer threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+
+        started = format_timestamp(datetime.datetime.now(datetime.UTC))
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO runs (started) VALUES (?)", (started,))
+            self.run = cursor.lastrowid
+            self._db.commit()
+
+    def _relpath(self, fname: str) -> str:
+        return os.path.relpath(fname, self.base_directory)
+
+    def _abspath(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.base_directory, path))
+
+    def get(self, title: str) -> sqlite3.Row | None:
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM files WHERE title = ?", (title,)
+            ).fetchone()
+
+    def is_fresh(
+        self,
+        title: str,
+        fname: str,
+        timestamp: datetime.datetime,
+        epoch: datetime.datetime,
+        check_exists: bool = True,
+    ) -> bool | None:
+        """
+        Check if the file recorded for @title is up-to-date with the given
+        timestamp on the wiki and not older than @epoch. Returns None if the
+        title is unknown. With @check_exists=False, the file does not have to
+        exist (e.g. when only its converted version is stored).
+        """
+        row = self.get(title)
+        if row is None or row["synced"] is None:
+            return None
+        if row["path"] != self._relpath(fname):
+            return False
+        if check_exists and not os.path.exists(fname):
+            return False
+        if parse_timestamp(row["touched"]) < timestamp:
+            return False
+        return parse_timestamp(row["synced"]) >= epoch
+
+    def mark_seen(self, title: str, fname: str, kind: str) -> None:
+        """Record that @title exists on the wiki and belongs to @fname."""
+        with self._lock:
+            self._db.execute(
+                """INSERT INTO files (title, kind, path, seen) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (title) DO UPDATE
+                   SET kind = excluded.kind, path = excluded.path, seen = excluded.seen""",
+                (title, kind, self._relpath(fname), self.run),
+            )
+
+    def mark_written(
+        self,
+        title: str,
+        content_hash: str,
+        timestamp: datetime.datetime,
+        revid: int | None = None,
+        changed: bool = True,
+    ) -> None:
+        """
+        Record that the content of @title is up-to-date. If @changed is False,
+        the content on the disk was already identical and the file is not
+        reported as changed in this run.
+        """
+        synced = format_timestamp(datetime.datetime.now(datetime.UTC))
+        with self._lock:
+            self._db.execute(
+                """UPDATE files SET hash = ?, touched = ?, revid = ?, synced = ?,
+                   changed = CASE WHEN ? THEN ? ELSE changed END
+                   WHERE title = ?""",
+                (content_hash, format_timestamp(timestamp), revid, synced, changed, self.run, title),
+            )
+
+    def remove(self, title: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE title = ?", (title,))
+            self._db.execute("DELETE FROM refs WHERE page = ?", (title,))
+
+    def prune(self) -> int:
+        """
+        Forget all files not seen in this run. Must be called only after a
+        full enumeration of the wiki. Returns the number of removed records.
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM files WHERE seen IS NOT ?", (self.run,)
+            )
+            self._db.execute(
+                "DELETE FROM refs WHERE page NOT IN (SELECT title FROM files)"
+            )
+            self._db.commit()
+            return cursor.rowcount
+
+    def files(self, kind: str) -> list[tuple[str, str, datetime.datetime, int | None]]:
+        """
+        Return (title, path, timestamp, revid) of all written files of the
+        given kind, the paths are prefixed with the output directory.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM files WHERE kind = ? AND synced IS NOT NULL ORDER BY path",
+                (kind,),
+            ).fetchall()
+        return [
+            (row["title"], self._abspath(row["path"]), parse_timestamp(row["touched"]), row["revid"])
+            for row in rows
+        ]
+
+    def hashes(self, kind: str) -> list[tuple[str, str, str]]:
+        """
+        Return (title, path, hash) of all written files of the given kind, the
+        paths are prefixed with the output directory.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT title, path, hash FROM files WHERE kind = ? AND synced IS NOT NULL ORDER BY path",
+                (kind,),
+            ).fetchall()
+        return [(row["title"], self._abspath(row["path"]), row["hash"]) for row in rows]
+
+    def set_hash(self, title: str, content_hash: str) -> None:
+        """Record that the file of @title was changed in place, e.g. recompressed."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE files SET hash = ?, changed = ? WHERE title = ? AND hash IS NOT ?",
+                (content_hash, self.run, title, content_hash),
+            )
+
+    def find_by_hash(self, content_hash: str, kind: str) -> list[str]:
+        """
+        Return paths of written files of the given kind with the given content
+        hash, prefixed with the output directory.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path FROM files WHERE hash = ? AND kind = ?",
+                (content_hash, kind),
+            ).fetchall()
+        return [self._abspath(row["path"]) for row in rows]
+
+    def set_references(self, page: str, images: set[str]) -> None:
+        """Record the titles of the images used on @page."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO refs (page, images) VALUES (?, ?)",
+                (page, json.dumps(sorted(images))),
+            )
+
+    def references(self) -> set[str]:
+        """Titles of the images used on any page in the manifest."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT images FROM refs WHERE page IN (SELECT title FROM files)"
+            ).fetchall()
+        images = set()
+        for row in rows:
+            images.update(json.loads(row["images"]))
+        return images
+
+    def pages_without_references(self) -> list[tuple[str, str]]:
+        """
+        Return (title, path) of the written pages without recorded image
+        references, e.g. pages downloaded by an older version.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT title, path FROM files WHERE kind = 'page' AND synced IS NOT NULL
+                   AND title NOT IN (SELECT page FROM refs)"""
+            ).fetchall()
+        return [(row["title"], self._abspath(row["path"])) for row in rows]
+
+    def merge(self, path: str) -> int:
+        """
+        Copy all records from the manifest at @path (e.g. of a shard synced
+        into the same output directory) and mark them as seen in this run.
+        Returns the number of copied records.
+        """
+        with self._lock:
+            self._db.commit()
+            self._db.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                cursor = self._db.execute(
+                    """INSERT OR REPLACE INTO files
+                       (title, kind, path, revid, touched, hash, synced, seen, changed)
+                       SELECT title, kind, path, revid, touched, hash, synced, ?, NULL
+                       FROM other.files""",
+                    (self.run,),
+                )
+                count = cursor.rowcount
+                self._db.execute("INSERT OR REPLACE INTO refs SELECT page, images FROM other.refs")
+                self._db.commit()
+            finally:
+                self._db.execute("DETACH DATABASE other")
+            return count
+
+    def paths(self) -> set[str]:
+        """Paths of all files in the manifest, prefixed with the output directory."""
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM files").fetchall()
+        return {self._abspath(row["path"]) for row in rows}
+
+    def changed(self, run: int | None = None) -> list[sqlite3.Row]:
+        """Records of files written in the given run (defaults to this run)."""
+        if run is None:
+            run = self.run
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM files WHERE changed = ? ORDER BY path", (run,)
+            ).fetchall()
+
+    def commit(self) -> None:
+        with self._lock:
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
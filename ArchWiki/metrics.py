@@ -0,0 +1,214 @@
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from typing import TextIO
+
+try:
+    from .atomic import atomic_open
+except ImportError:
+    # executed as a script, see converter.py
+    from atomic import atomic_open
+
+
+class Metrics:
+    """
+    Counters and per-stage timings of a run, shared by all threads.
+
+    Stage durations are summed over all threads (and processes, for the
+    stages measured in the workers), so with concurrent downloads they can
+    exceed the wall-clock time of the run.
+
+    Per-item messages are printed only in the verbose mode. Otherwise a
+    compact progress line is kept updated on the terminal.
+    """
+
+    # prefix of the metric names in the Prometheus output
+    prefix = "arch_wiki_docs"
+
+    # minimum interval between updates of the progress line, in seconds
+    progress_interval = 0.5
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        progress: bool | None = None,
+        stream: TextIO | None = None,
+    ):
+        """
+        @verbose:  print a line for each processed item
+        @progress: show the progress line (default: if @stream is a terminal
+                   and @verbose is not set)
+        @stream:   where to show the progress line (default: stderr)
+        """
+        self.verbose = verbose
+        self.stream = stream or sys.stderr
+        if progress is None:
+            progress = not verbose and self.stream.isatty()
+        self.progress = progress
+
+        self.counters: collections.Counter[str] = collections.Counter()
+        self.durations: dict[str, float] = {}
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._last_progress = 0.0
+        self._progress_shown = False
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Add the time spent in the block to the duration of @stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0) + seconds
+
+    def add_times(self, timings: dict[str, float], prefix: str = "") -> None:
+        """Merge durations measured elsewhere, e.g. in worker processes."""
+        with self._lock:
+            for stage, seconds in timings.items():
+                stage = prefix + stage
+                self.durations[stage] = self.durations.get(stage, 0) + seconds
+
+    def timed_iter(self, iterable: Iterable, stage: str) -> Iterator:
+        """
+        Iterate over @iterable, counting the time spent waiting for the items
+        (e.g. API continuation queries) to @stage, but not the time spent by
+        the consumer of the items.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+        if self.progress:
+            self.show_progress()
+
+    def log(self, message: str) -> None:
+        """Print a per-item message, only in the verbose mode."""
+        if self.verbose:
+            self.print(message)
+
+    def print(self, message: str) -> None:
+        """Print a message without breaking the progress line."""
+        with self._lock:
+            if self._progress_shown:
+                self.stream.write("\r\033[K")
+                self.stream.flush()
+                self._progress_shown = False
+        print(message)
+
+    def status(self) -> str:
+        c = self.counters
+        parts = [
+            f"{c['pages_downloaded']} pages",
+            f"{c['images_downloaded']} images downloaded",
+            f"{c['up_to_date']} up-to-date",
+            f"{c['cache_hits']} not modified",
+            f"{c['bytes_downloaded'] / 2**20:.1f} MiB",
+        ]
+        if c["pages_converted"]:
+            parts.append(f"{c['pages_converted']} converted")
+        if c["images_optimized"]:
+            parts.append(f"{c['images_optimized']} images optimized ({c['image_bytes_saved'] / 2**20:.1f} MiB saved)")
+        if c["errors"]:
+            parts.append(f"{c['errors']} errors")
+        parts.append(f"{time.perf_counter() - self._start:.0f} s")
+        return ", ".join(parts)
+
+    def show_progress(self, force: bool = False) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            if not force and now - self._last_progress < self.progress_interval:
+                return
+            self._last_progress = now
+            self.stream.write("\r\033[K" + self.status())
+            self.stream.flush()
+            self._progress_shown = True
+
+    def end_progress(self) -> None:
+        """Finish the progress line, e.g. at the end of a stage."""
+        if not self.progress:
+            return
+        self.show_progress(force=True)
+        with self._lock:
+            self.stream.write("\n")
+            self.stream.flush()
+            self._progress_shown = False
+
+    def report(self) -> None:
+        """Print a summary of the run."""
+        self.end_progress()
+        print(f"Finished in {time.perf_counter() - self._start:.1f} s: {self.status()}")
+        if self.durations:
+            print("Time spent in each stage (summed over threads and processes):")
+            for stage, seconds in sorted(self.durations.items()):
+                print(f"  {stage:<20} {seconds:10.3f} s")
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "duration": time.perf_counter() - self._start,
+                "counters": dict(sorted(self.counters.items())),
+                "stages": dict(sorted(self.durations.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Format the metrics for the textfile collector of node_exporter."""
+        data = self.as_dict()
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_run_start_time_seconds Start time of the last run.",
+            f"# TYPE {p}_run_start_time_seconds gauge",
+            f"{p}_run_start_time_seconds {data['started']:.3f}",
+            f"# HELP {p}_run_duration_seconds Duration of the last run.",
+            f"# TYPE {p}_run_duration_seconds gauge",
+            f"{p}_run_duration_seconds {data['duration']:.3f}",
+            f"# HELP {p}_stage_duration_seconds Time spent in each stage of the last run.",
+            f"# TYPE {p}_stage_duration_seconds gauge",
+        ]
+        for stage, seconds in data["stages"].items():
+            lines.append(f'{p}_stage_duration_seconds{{stage="{stage}"}} {seconds:.6f}')
+        for name, value in data["counters"].items():
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, format: str | None = None) -> None:
+        """
+        Write the metrics to @path, atomically so that a collector never sees
+        a partial file. The @format is "json" or "prometheus"; by default it
+        is "prometheus" for files with the '.prom' extension and "json"
+        otherwise.
+        """
+        if format is None:
+            format = "prometheus" if path.endswith(".prom") else "json"
+        if format == "prometheus":
+            content = self.to_prometheus()
+        elif format == "json":
+            content = self.to_json() + "\n"
+        else:
+            raise ValueError(f"unknown metrics format: {format}")
+        with atomic_open(path) as fd:
+            fd.write(content)
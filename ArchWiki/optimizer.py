@@ -2,14 +2,179 @@ import hashlib
 import os
 import re
 import urllib.parse
+from collections.abc import Iterable
 
+import lxml.cssselect
 import lxml.etree
 import lxml.html
 import ws.ArchWiki.lang
 from ws.client.api import API
 
 
+class LinkIndex:
+    """
+    Mapping of wiki link targets to local paths relative to the output
+    directory, with redirects resolved. Entries are computed once per title
+    and shared by all pages (and inherited by forked worker processes).
+
+    Once the index is complete (built or loaded from a SiteSnapshot), titles
+    missing in it are not pages in the downloaded namespaces, so they are
+    resolved without the redirect map of the API. In the offline mode they
+    are not resolved at all and the links are left untouched.
+    """
+
+    # namespaces enumerated by build()
+    namespaces = ["0", "4", "12", "14"]
+
+    def __init__(self, optimizer: "Optimizer"):
+        self.optimizer = optimizer
+        # link title (MediaWiki URL form) -> (relative path or None, fragment)
+        self.index: dict[str, tuple[str | None, str]] = {}
+        self.complete = False
+        self.offline = False
+
+    @staticmethod
+    def _key(title: str) -> str:
+        return title.replace(" ", "_")
+
+    def compute(self, title: str, follow_redirects: bool = True) -> tuple[str | None, str]:
+        """
+        Resolve redirect and local path of a link target without the index.
+        The path is None for pages skipped by get_local_filename.
+        """
+        resolved = None
+        if follow_redirects:
+            resolved = self.optimizer.api.redirects.resolve(title)
+        if resolved is None:
+            resolved = title
+        try:
+            resolved, fragment = resolved.split("#", maxsplit=1)
+            # FIXME has to be dot-encoded
+            fragment = fragment.replace(" ", "_")
+        except ValueError:
+            fragment = ""
+        return self.optimizer.get_local_filename(resolved, "."), fragment
+
+    def resolve(self, title: str) -> tuple[str | None, str]:
+        key = self._key(title)
+        try:
+            return self.index[key]
+        except KeyError:
+            if self.offline:
+                return None, ""
+            entry = self.index[key] = self.compute(title, follow_redirects=not self.complete)
+            return entry
+
+    def build(self) -> None:
+        """
+        Fill the index with all pages and redirects in the namespaces which
+        are downloaded, using one enumeration per namespace.
+        """
+        for ns in self.namespaces:
+            allpages = self.optimizer.api.generator(
+                generator="allpages",
+                gaplimit="max",
+                gapnamespace=ns,
+            )
+            for page in allpages:
+                self.resolve(page["title"])
+        self.complete = True
+
+    def load(self, entries: dict[str, tuple[str | None, str]]) -> None:
+        """Replace the index with complete entries saved by a previous run."""
+        self.index = dict(entries)
+        self.complete = True
+
+    def update(self, titles: Iterable[str]) -> None:
+        """
+        Recompute the entries of the given (changed) titles and of the
+        redirects pointing to them. Redirects are resolved by querying the
+        titles in batches, which is much cheaper than the full redirect map.
+        """
+        keys = {self._key(title) for title in titles}
+        paths = {self.index[key][0] for key in keys if key in self.index}
+        paths.discard(None)
+        keys |= {key for key, (path, fragment) in self.index.items() if path in paths}
+
+        keys = sorted(keys)
+        for i in range(0, len(keys), 50):
+            batch = keys[i : i + 50]
+            result = self.optimizer.api.call_api(
+                action="query", titles="|".join(batch), redirects=True
+            )
+            normalized = {n["from"]: n["to"] for n in result.get("normalized", [])}
+            redirects = {
+                r["from"]: (r["to"], r.get("tofragment", ""))
+                for r in result.get("redirects", [])
+            }
+            for key in batch:
+                title = normalized.get(key, key)
+                target, fragment = redirects.get(title, (title, ""))
+                self.index[key] = (
+                    self.optimizer.get_local_filename(target, "."),
+                    fragment.replace(" ", "_"),
+                )
+
+
+class OptimizedPage:
+    """
+    Result of Optimizer.optimize_page(): the optimized HTML (unless it was
+    not requested), the titles of the images shown on the page and, if
+    requested, the heading and the plain text of the page and the result of
+    its conversion. Pages optimized in a worker process carry also the link
+    index entries computed there.
+    """
+
+    def __init__(
+        self,
+        html: str | None,
+        images: set[str],
+        heading: str | None = None,
+        text: str | None = None,
+    ):
+        self.html = html
+        self.images = images
+        self.heading = heading
+        self.text = text
+        # SHA-256 hash of the converted page (None if the conversion failed),
+        # error message of a failed conversion and time spent in the conversion stages
+        self.converted_hash: str | None = None
+        self.convert_error: str | None = None
+        self.convert_timings: dict[str, float] = {}
+        # link index entries computed in a worker process, which have to be
+        # merged into the index of the parent (see Downloader.optimize)
+        self.links: dict[str, tuple[str | None, str]] = {}
+
+
 class Optimizer:
+    # elements useless in offline browsing
+    strip_selector = lxml.cssselect.CSSSelector(
+        "#archnavbar, #mw-navigation, header.mw-header, .vector-sitenotice-container, .vector-page-toolbar, #p-lang-btn"
+    )
+    # the same selector decomposed for the single-pass engine
+    strip_ids = frozenset(["archnavbar", "mw-navigation", "p-lang-btn"])
+    strip_classes = frozenset(["vector-sitenotice-container", "vector-page-toolbar"])
+    strip_tag_classes = frozenset([("header", "mw-header")])
+
+    # other selectors and expressions used by the multi-pass methods
+    content_selector = lxml.cssselect.CSSSelector("#content")
+    footer_selector = lxml.cssselect.CSSSelector("#footer")
+    footer_info_selector = lxml.cssselect.CSSSelector("#footer-info")
+    printfooter_selector = lxml.cssselect.CSSSelector("div.printfooter")
+    a_selector = lxml.cssselect.CSSSelector("a")
+    img_selector = lxml.cssselect.CSSSelector("img")
+    stylesheets_xpath = lxml.etree.XPath('//head/link[@rel="stylesheet"]')
+
+    link_regex = re.compile(
+        "^(https://wiki.archlinux.org)?/title/(?P<title>.+?)(?:#(?P<fragment>.+))?$"
+    )
+    # original file name in the URL of an uploaded image or its thumbnail
+    image_regex = re.compile(
+        "^/images/(?:thumb/)?[0-9a-f]/[0-9a-f]{2}/(?P<name>[^/]+)"
+    )
+    # whitespace as understood by normalize-space() in XPath
+    class_separator = re.compile("[ \t\r\n]+")
+
     def __init__(
         self,
         api: API,
@@ -28,6 +193,7 @@ class Optimizer:
         self.base_directory = base_directory
         self.safe_filenames = safe_filenames
         self.langs = langs or ws.ArchWiki.lang.get_language_tags()
+        self.link_index = LinkIndex(self)
 
     def get_local_filename(self, title: str, basepath: str) -> str | None:
         """Return file name where the given page should be stored, relative to 'basepath'."""
@@ -79,6 +245,44 @@ class Optimizer:
         return os.path.normpath(path)
 
     def optimize(self, title: str, html_content: str) -> str:
+        return self.serialize(self.optimize_tree(title, html_content))
+
+    def optimize_page(
+        self,
+        title: str,
+        html_content: str,
+        extract_text: bool = False,
+        serialize: bool = True,
+        converter=None,
+    ) -> OptimizedPage:
+        """
+        Same as optimize(), but return also the images referenced by the page
+        and, with @extract_text, the heading and the plain text of the page
+        for the search index. All are taken from the same tree.
+
+        If @converter (e.g. ArchWiki.converter.Converter) is given, the tree is
+        passed directly to its convert_tree method after everything else, so
+        the page is not parsed again. A failed conversion is reported in
+        convert_error of the result. With @serialize=False the optimized HTML
+        is not produced at all.
+        """
+        images: set[str] = set()
+        root = self.optimize_tree(title, html_content, images)
+        page = OptimizedPage(self.serialize(root) if serialize else None, images)
+        if extract_text:
+            page.heading, page.text = self.extract_text(root)
+        if converter is not None:
+            # the converter modifies the tree
+            content, page.convert_error = converter.run_tree_job(root, title, page.convert_timings)
+            if content is not None:
+                page.converted_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        return page
+
+    def optimize_tree(self, title: str, html_content: str, images: set[str] | None = None):
+        """
+        Parse and optimize the page, return the lxml tree. Titles of the
+        referenced images are added to @images, if given.
+        """
         # path relative from the HTML file to base output directory
         relbase = os.path.relpath(self.base_directory, os.path.dirname(title))
 
@@ -88,13 +292,30 @@ class Optimizer:
         root = lxml.html.document_fromstring(html_content)
 
         # optimize
+        self.transform(root, relbase, css_path, images)
+
+        return root
+
+    def optimize_multipass(self, title: str, html_content: str) -> str:
+        """
+        Reference implementation of optimize() which applies each
+        transformation in a separate pass over the tree. The output must be
+        identical to optimize().
+        """
+        relbase = os.path.relpath(self.base_directory, os.path.dirname(title))
+        css_path = os.path.join(relbase, "ArchWikiOffline.css")
+        root = lxml.html.document_fromstring(html_content)
+
         self.strip_page(root)
         self.fix_layout(root)
         self.replace_css_links(root, css_path)
         self.update_links(root, relbase)
         self.fix_footer(root)
 
-        # return output
+        return self.serialize(root)
+
+    @staticmethod
+    def serialize(root) -> str:
         return lxml.etree.tostring(
             root,
             pretty_print=True,
@@ -103,12 +324,88 @@ class Optimizer:
             doctype="<!DOCTYPE html>",
         )
 
+    @staticmethod
+    def extract_text(root) -> tuple[str, str]:
+        """Return the heading and the plain text of the content of a page."""
+        heading = root.get_element_by_id("firstHeading", None)
+        content = root.get_element_by_id("mw-content-text", None)
+        heading = heading.text_content().strip() if heading is not None else ""
+        text = content.text_content() if content is not None else ""
+        return heading, " ".join(text.split())
+
+    def extract_text_from_file(self, fname: str) -> tuple[str, str]:
+        """Same as extract_text() for an optimized page stored in @fname."""
+        return self.extract_text(lxml.html.parse(fname).getroot())
+
+    def is_stripped(self, element) -> bool:
+        """check if the element matches the strip_selector"""
+
+        if element.get("id") in self.strip_ids:
+            return True
+        classes = element.get("class")
+        if classes is None:
+            return False
+        classes = self.class_separator.split(classes)
+        for c in classes:
+            if c in self.strip_classes or (element.tag, c) in self.strip_tag_classes:
+                return True
+        return False
+
+    def transform(self, root, relbase, css_path, images=None):
+        """
+        Apply all transformations of the multi-pass methods (strip_page,
+        fix_layout, replace_css_links, update_links and fix_footer) in one
+        traversal of the tree. Subtrees of removed elements are not visited,
+        operations depending on the whole tree are applied at the end.
+        Titles of the referenced images are added to @images, if given.
+        """
+
+        stylesheets = []
+        printfooters = []
+        footer_infos = []
+
+        stack = [root]
+        while stack:
+            e = stack.pop()
+            tag = e.tag
+
+            # strip comments (including IE 6/7 fixes, which are useless for an Arch package)
+            if not isinstance(tag, str):
+                if tag is lxml.etree.Comment:
+                    e.getparent().remove(e)
+                continue
+
+            if e is not root and (tag == "script" or self.is_stripped(e)):
+                e.getparent().remove(e)
+                continue
+
+            id_ = e.get("id")
+            if id_ == "content" or id_ == "footer":
+                e.set("style", "margin: 0")
+            elif id_ == "footer-info":
+                footer_infos.append(e)
+
+            if tag == "a":
+                self.update_link(e, relbase)
+            elif tag == "img":
+                self.update_image(e, relbase, images)
+            elif tag == "link":
+                if e.get("rel") == "stylesheet" and e.getparent().tag == "head":
+                    stylesheets.append(e)
+            elif tag == "div" and "printfooter" in self.class_separator.split(e.get("class", "")):
+                printfooters.append(e)
+
+            # visit children in document order
+            stack.extend(reversed(e))
+
+        self._replace_stylesheets(stylesheets, css_path)
+        for printfooter in printfooters:
+            self._move_printfooter(printfooter, footer_infos[0])
+
     def strip_page(self, root):
         """remove elements useless in offline browsing"""
 
-        for e in root.cssselect(
-            "#archnavbar, #mw-navigation, header.mw-header, .vector-sitenotice-container, .vector-page-toolbar, #p-lang-btn"
-        ):
+        for e in self.strip_selector(root):
             e.getparent().remove(e)
 
         # strip comments (including IE 6/7 fixes, which are useless for an Arch package)
@@ -121,16 +418,17 @@ class Optimizer:
         """fix page layout after removing some elements"""
 
         # in case of select-by-id a list with max one element is returned
-        for c in root.cssselect("#content"):
+        for c in self.content_selector(root):
             c.set("style", "margin: 0")
-        for f in root.cssselect("#footer"):
+        for f in self.footer_selector(root):
             f.set("style", "margin: 0")
 
     def replace_css_links(self, root, css_path):
         """force using local CSS"""
 
-        links = root.xpath('//head/link[@rel="stylesheet"]')
+        self._replace_stylesheets(self.stylesheets_xpath(root), css_path)
 
+    def _replace_stylesheets(self, links, css_path):
         # overwrite first
         links[0].set("href", css_path)
 
@@ -138,44 +436,64 @@ class Optimizer:
         for link in links[1:]:
             link.getparent().remove(link)
 
-    def update_links(self, root, relbase):
-        """change "internal" wiki links into relative"""
-
-        for a in root.cssselect("a"):
-            href = a.get("href")
-            if href is not None:
-                href = urllib.parse.unquote(href)
-                # matching full URL is necessary for interlanguage links
-                match = re.match(
-                    "^(https://wiki.archlinux.org)?/title/(?P<title>.+?)(?:#(?P<fragment>.+))?$",
-                    str(href),
-                )
-                if match:
-                    title = self.api.redirects.resolve(match.group("title"))
-                    if title is None:
-                        title = match.group("title")
-                    try:
-                        title, fragment = title.split("#", maxsplit=1)
-                        # FIXME has to be dot-encoded
-                        fragment = fragment.replace(" ", "_")
-                    except ValueError:
-                        fragment = ""
-                    # explicit fragment overrides the redirect
-                    if match.group("fragment"):
-                        fragment = match.group("fragment")
-                    href = self.get_local_filename(title, relbase)
-                    # get_local_filename returns None for skipped pages
-                    if href is None:
-                        continue
-                    if fragment:
-                        href += "#" + fragment
-                    a.set("href", href)
-
-        for i in root.cssselect("img"):
+    def update_links(self, root, relbase, images=None):
+        """
+        change "internal" wiki links into relative, add titles of the
+        referenced images to @images (if given)
+        """
+
+        for a in self.a_selector(root):
+            self.update_link(a, relbase)
+
+        for i in self.img_selector(root):
+            self.update_image(i, relbase, images)
+
+    def update_link(self, a, relbase):
+        href = a.get("href")
+        if href is not None:
+            href = urllib.parse.unquote(href)
+            # matching full URL is necessary for interlanguage links
+            match = self.link_regex.match(str(href))
+            if match:
+                path, fragment = self.link_index.resolve(match.group("title"))
+                # get_local_filename returns None for skipped pages
+                if path is None:
+                    return
+                # explicit fragment overrides the redirect
+                if match.group("fragment"):
+                    fragment = match.group("fragment")
+                href = os.path.normpath(os.path.join(relbase, path))
+                if fragment:
+                    href += "#" + fragment
+                a.set("href", href)
+
+    def image_name(self, src: str) -> str:
+        """
+        Return the file name of an uploaded image given its URL. Thumbnails
+        are mapped to the original image, which is the one downloaded.
+        """
+        match = self.image_regex.match(src)
+        if match:
+            return match.group("name")
+        return os.path.split(src)[1]
+
+    def collect_images(self, html_content: str) -> set[str]:
+        """Return the titles of all uploaded images used in an unmodified page."""
+        images = set()
+        for i in self.img_selector(lxml.html.document_fromstring(html_content)):
             src = i.get("src")
             if src and src.startswith("/images/"):
-                src = os.path.join(relbase, "File:" + os.path.split(src)[1])
-                i.set("src", src)
+                images.add("File:" + urllib.parse.unquote(self.image_name(src)).replace("_", " "))
+        return images
+
+    def update_image(self, i, relbase, images=None):
+        src = i.get("src")
+        if src and src.startswith("/images/"):
+            name = self.image_name(src)
+            if images is not None:
+                images.add("File:" + urllib.parse.unquote(name).replace("_", " "))
+            src = os.path.join(relbase, "File:" + name)
+            i.set("src", src)
 
     def fix_footer(self, root):
         """
@@ -185,10 +503,12 @@ class Optimizer:
         the categories list from the real footer.)
         """
 
-        for printfooter in root.cssselect("div.printfooter"):
-            printfooter.attrib.pop("class")
-            printfooter.tag = "li"
-            f_list = root.cssselect("#footer-info")[0]
-            f_list.insert(0, printfooter)
-            br = lxml.etree.Element("br")
-            f_list.insert(3, br)
+        for printfooter in self.printfooter_selector(root):
+            self._move_printfooter(printfooter, self.footer_info_selector(root)[0])
+
+    def _move_printfooter(self, printfooter, f_list):
+        printfooter.attrib.pop("class")
+        printfooter.tag = "li"
+        f_list.insert(0, printfooter)
+        br = lxml.etree.Element("br")
+        f_list.insert(3, br)
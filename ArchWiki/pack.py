@@ -0,0 +1,220 @@
+import datetime
+import http.server
+import json
+import mimetypes
+import os
+import posixpath
+import threading
+import urllib.parse
+import zipfile
+from collections.abc import Iterable
+
+# formats which are already compressed and stored as they are
+STORED_EXTENSIONS = frozenset([".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".gz", ".zip"])
+
+
+class PackWriter:
+    """
+    Writer of a single-file pack of the output directory. The pack is a ZIP
+    archive whose keys are the paths relative to the output directory, as
+    returned by Optimizer.get_local_filename() for the base path ".". Pages
+    are deflated, already compressed images are stored.
+
+    The archive is written to a temporary file and moved into place by
+    close(), so readers never see an incomplete pack.
+    """
+
+    # member with the mapping of titles to keys, not a valid page path
+    index_name = ".index.json"
+
+    def __init__(self, path: str, compresslevel: int = 9):
+        self.path = path
+        self._tmp = path + ".tmp"
+        self._zip = zipfile.ZipFile(
+            self._tmp, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+        )
+        self.titles: dict[str, str] = {}
+
+    @staticmethod
+    def _compression(name: str) -> int:
+        if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def add_file(self, name: str, fname: str, title: str | None = None) -> None:
+        """Add the file @fname under the key @name."""
+        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(fname), tz=datetime.UTC)
+        info = zipfile.ZipInfo(name, date_time=mtime.timetuple()[:6])
+        info.compress_type = self._compression(name)
+        info.external_attr = 0o644 << 16
+        with open(fname, "rb") as src, self._zip.open(info, "w") as dst:
+            for chunk in iter(lambda: src.read(65536), b""):
+                dst.write(chunk)
+        if title is not None:
+            self.titles[title] = name
+
+    def close(self) -> None:
+        self._zip.writestr(self.index_name, json.dumps(self.titles, sort_keys=True))
+        self._zip.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        self._zip.close()
+        os.unlink(self._tmp)
+
+
+def write_pack(
+    path: str, base_directory: str, files: Iterable[tuple[str | None, str]]
+) -> int:
+    """
+    Pack the given files of the output directory into @path.
+
+    @path:           path to the pack to (re)create
+    @base_directory: output directory, the keys are relative to it
+    @files:          (title, path) of the files to pack, the title may be None
+    Returns the number of packed files.
+    """
+    writer = PackWriter(path)
+    count = 0
+    try:
+        for title, fname in sorted(files, key=lambda item: item[1]):
+            name = os.path.relpath(fname, base_directory).replace(os.sep, "/")
+            writer.add_file(name, fname, title)
+            count += 1
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return count
+
+
+class PackReader:
+    """
+    Random access to the files in a pack. The central directory of the
+    archive is read once when opening it, afterwards each file is located in
+    constant time. The reader can be shared by multiple threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "r")
+        self._titles: dict[str, str] | None = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return self.info(name) is not None
+
+    def names(self) -> list[str]:
+        return [name for name in self._zip.namelist() if name != PackWriter.index_name]
+
+    def info(self, name: str) -> zipfile.ZipInfo | None:
+        try:
+            return self._zip.getinfo(name)
+        except KeyError:
+            return None
+
+    def read(self, name: str) -> bytes:
+        """Return the content of the file with the key @name."""
+        return self._zip.read(name)
+
+    def lookup(self, title: str) -> str | None:
+        """Return the key of the page or image with the given title."""
+        with self._lock:
+            if self._titles is None:
+                try:
+                    self._titles = json.loads(self._zip.read(PackWriter.index_name))
+                except KeyError:
+                    self._titles = {}
+        return self._titles.get(title.replace("_", " "), self._titles.get(title))
+
+    def close(self) -> None:
+        self._zip.close()
+
+
+class PackRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the files of a pack over HTTP. Wiki-style URLs ('/title/Foo') are
+    redirected to the path of the page in the pack.
+    """
+
+    reader: PackReader
+    index_page = "en/Main_page.html"
+
+    def do_HEAD(self) -> None:
+        self.do_GET(body=False)
+
+    def do_GET(self, body: bool = True) -> None:
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        name = posixpath.normpath(path).lstrip("/")
+
+        if name in ("", "."):
+            return self._redirect(self.index_page)
+        if name.startswith("title/"):
+            target = self.reader.lookup(name[len("title/"):])
+            if target is None:
+                return self.send_error(404)
+            return self._redirect(target)
+
+        info = self.reader.info(name)
+        if info is None or name == PackWriter.index_name:
+            return self.send_error(404)
+
+        etag = f'"{info.CRC:08x}-{info.file_size}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        data = self.reader.read(name)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _redirect(self, name: str) -> None:
+        self.send_response(302)
+        self.send_header("Location", "/" + urllib.parse.quote(name))
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        # keep the terminal quiet, errors are still reported by log_error
+        pass
+
+
+def serve(path: str, address: tuple[str, int] = ("127.0.0.1", 8000)) -> None:
+    """Browse the pack at @path on http://address/ until interrupted."""
+    reader = PackReader(path)
+    handler = type("Handler", (PackRequestHandler,), {"reader": reader})
+    server = http.server.ThreadingHTTPServer(address, handler)
+    print(f"Serving {path} on http://{address[0]}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        reader.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="Browse a pack created by arch-wiki-docs.py --pack")
+    argparser.add_argument("pack", help="Path to the pack.")
+    argparser.add_argument("--address", default="127.0.0.1", help="Address to listen on (default: %(default)s).")
+    argparser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: %(default)s).")
+    argparser.add_argument("--list", action="store_true", help="List the files in the pack instead of serving them.")
+    args = argparser.parse_args()
+
+    if args.list:
+        for name in PackReader(args.pack).names():
+            print(name)
+    else:
+        serve(args.pack, (args.address, args.port))
@@ -0,0 +1,277 @@
+import collections
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+
+from .atomic import atomic_open
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    lang TEXT NOT NULL,
+    title TEXT NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    shard TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    weight INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_shard ON postings(lang, shard);
+CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc);
+CREATE TABLE IF NOT EXISTS dirty (
+    lang TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (lang, name)
+);
+"""
+
+# word characters, the same as [\p{L}\p{N}_] in the JavaScript client
+_word_regex = re.compile(r"\w+")
+# ideographs, which are not separated by spaces and are indexed as bigrams
+_cjk_regex = re.compile("[\u2e80-\u9fff\uf900-\ufaff]")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split text into search terms. The JavaScript client in search.html uses
+    the same rules, any change here has to be done there too.
+    """
+    terms = []
+    for word in _word_regex.findall(text.lower()):
+        if _cjk_regex.search(word):
+            if len(word) == 1:
+                terms.append(word)
+            else:
+                terms.extend(word[i : i + 2] for i in range(len(word) - 1))
+        elif len(word) > 1:
+            terms.append(word)
+    return terms
+
+
+def shard_name(term: str, length: int = 2) -> str:
+    """Name of the shard file containing @term: its hex-encoded prefix."""
+    return "t-" + term[:length].encode("utf-8").hex()
+
+
+class SearchIndex:
+    """
+    Inverted index of the plain text of the pages, for the offline search
+    page. The postings are stored in an SQLite database in the state
+    directory and exported as small JavaScript files in the 'search'
+    directory of the output:
+
+    - '<lang>/t-<prefix>.js' with the postings of all terms starting with
+      the prefix (2 characters, hex-encoded),
+    - '<lang>/d-<n>.js' with the paths, titles and summaries of the
+      documents with ids from n*chunk_size to (n+1)*chunk_size-1,
+    - 'languages.js' with the indexed languages.
+
+    The files call a global function when loaded via <script>, so that the
+    search page works also from file:// URLs. Only the files affected by the
+    pages updated since the last export are written again.
+    """
+
+    # directory of the exported files, relative to the output directory
+    dirname = "search"
+    # number of documents per document file
+    chunk_size = 500
+    # maximum number of documents listed for each term, the best are kept
+    max_postings = 200
+    # bonus for terms in the title of the page
+    title_weight = 10
+    # length of the summary shown in the results
+    summary_length = 200
+
+    client = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search.html")
+
+    def __init__(self, path: str, base_directory: str):
+        """
+        @path:           path to the database file
+        @base_directory: output directory; the paths of the pages are stored
+                         relative to it and the index is exported to its
+                         'search' subdirectory
+        """
+        self.path = path
+        self.base_directory = base_directory
+        self.directory = os.path.join(base_directory, self.dirname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # the connection is shared by the writer and download threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def _relpath(self, fname: str) -> str:
+        return os.path.relpath(fname, self.base_directory).replace(os.sep, "/")
+
+    def _mark_dirty(self, lang: str, doc: int, shards: set[str]) -> None:
+        self._db.executemany(
+            "INSERT OR IGNORE INTO dirty (lang, name) VALUES (?, ?)",
+            [(lang, name) for name in shards | {f"d-{doc // self.chunk_size}"}],
+        )
+
+    def _drop_postings(self, doc: int, lang: str) -> None:
+        shards = {
+            row[0]
+            for row in self._db.execute("SELECT DISTINCT shard FROM postings WHERE doc = ?", (doc,))
+        }
+        self._db.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+        self._mark_dirty(lang, doc, shards)
+
+    def paths(self) -> set[str]:
+        """Paths of the indexed pages, prefixed with the output directory."""
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM documents").fetchall()
+        return {os.path.normpath(os.path.join(self.base_directory, row[0])) for row in rows}
+
+    def update(self, fname: str, title: str, text: str) -> None:
+        """
+        Index the page stored in @fname. The language is determined by the
+        first component of the path, see Optimizer.get_local_filename.
+        """
+        path = self._relpath(fname)
+        lang = path.split("/", 1)[0]
+
+        weights: collections.Counter[str] = collections.Counter(tokenize(text))
+        for term in set(tokenize(title)):
+            weights[term] += self.title_weight
+        summary = text[: self.summary_length]
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, lang FROM documents WHERE path = ?", (path,)
+            ).fetchone()
+            if row is None:
+                cursor = self._db.execute(
+                    "INSERT INTO documents (path, lang, title, summary) VALUES (?, ?, ?, ?)",
+                    (path, lang, title, summary),
+                )
+                doc = cursor.lastrowid
+            else:
+                doc = row[0]
+                self._drop_postings(doc, row[1])
+                self._db.execute(
+                    "UPDATE documents SET lang = ?, title = ?, summary = ? WHERE id = ?",
+                    (lang, title, summary, doc),
+                )
+            self._db.executemany(
+                "INSERT INTO postings (term, shard, lang, doc, weight) VALUES (?, ?, ?, ?, ?)",
+                [(term, shard_name(term), lang, doc, w) for term, w in weights.items()],
+            )
+            self._mark_dirty(lang, doc, {shard_name(term) for term in weights})
+
+    def remove(self, fname: str) -> None:
+        path = self._relpath(fname)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, lang FROM documents WHERE path = ?", (path,)
+            ).fetchone()
+            if row is not None:
+                self._drop_postings(row[0], row[1])
+                self._db.execute("DELETE FROM documents WHERE id = ?", (row[0],))
+
+    def retain(self, fnames: set[str]) -> int:
+        """
+        Remove all pages not given in @fnames from the index. Returns the
+        number of removed pages.
+        """
+        stale = self.paths() - fnames
+        for fname in stale:
+            self.remove(fname)
+        return len(stale)
+
+    def _write_js(self, lang: str, name: str, callback: str, data: dict) -> None:
+        path = os.path.join(self.directory, lang, name + ".js")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path, encoding="utf-8") as fd:
+            fd.write(f"{callback}({json.dumps(data, ensure_ascii=False, separators=(',', ':'))});\n")
+
+    def _remove_js(self, lang: str, name: str) -> None:
+        try:
+            os.unlink(os.path.join(self.directory, lang, name + ".js"))
+        except FileNotFoundError:
+            pass
+
+    def _export_terms(self, lang: str, name: str) -> None:
+        rows = self._db.execute(
+            "SELECT term, doc, weight FROM postings WHERE lang = ? AND shard = ? "
+            "ORDER BY term, weight DESC, doc",
+            (lang, name),
+        ).fetchall()
+        if not rows:
+            self._remove_js(lang, name)
+            return
+        terms: dict[str, list[list[int]]] = {}
+        for term, doc, weight in rows:
+            postings = terms.setdefault(term, [])
+            if len(postings) < self.max_postings:
+                postings.append([doc, weight])
+        self._write_js(lang, name, "searchTerms", {"lang": lang, "shard": name, "terms": terms})
+
+    def _export_documents(self, lang: str, name: str) -> None:
+        chunk = int(name[2:])
+        rows = self._db.execute(
+            "SELECT id, path, title, summary FROM documents WHERE lang = ? AND id >= ? AND id < ?",
+            (lang, chunk * self.chunk_size, (chunk + 1) * self.chunk_size),
+        ).fetchall()
+        if not rows:
+            self._remove_js(lang, name)
+            return
+        docs = {row[0]: [row[1], row[2], row[3]] for row in rows}
+        self._write_js(lang, name, "searchDocuments", {"lang": lang, "chunk": name, "docs": docs})
+
+    def _mark_missing(self) -> None:
+        """Mark the exported files which do not exist (e.g. were deleted) as dirty."""
+        shards = self._db.execute("SELECT DISTINCT lang, shard FROM postings").fetchall()
+        chunks = self._db.execute(
+            "SELECT DISTINCT lang, 'd-' || (id / ?) FROM documents", (self.chunk_size,)
+        ).fetchall()
+        missing = [
+            (lang, name) for lang, name in shards + chunks
+            if not os.path.exists(os.path.join(self.directory, lang, name + ".js"))
+        ]
+        self._db.executemany("INSERT OR IGNORE INTO dirty (lang, name) VALUES (?, ?)", missing)
+
+    def write(self) -> int:
+        """
+        Export the parts of the index changed since the last export or missing
+        in the output, together with the search page. Returns the number of
+        exported files.
+        """
+        with self._lock:
+            self._mark_missing()
+            dirty = self._db.execute("SELECT lang, name FROM dirty").fetchall()
+            for lang, name in dirty:
+                if name.startswith("t-"):
+                    self._export_terms(lang, name)
+                else:
+                    self._export_documents(lang, name)
+            languages = dict(
+                self._db.execute("SELECT lang, COUNT(*) FROM documents GROUP BY lang").fetchall()
+            )
+            self._db.execute("DELETE FROM dirty")
+            self._db.commit()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_js("", "languages", "searchLanguages", {
+            "languages": languages,
+            "chunk_size": self.chunk_size,
+        })
+        shutil.copyfile(self.client, os.path.join(self.directory, "index.html"))
+        return len(dirty)
+
+    def commit(self) -> None:
+        with self._lock:
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
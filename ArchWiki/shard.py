@@ -0,0 +1,41 @@
+import hashlib
+
+
+class Shard:
+    """
+    One of @count slices of the titles on the wiki, for synchronizing a full
+    mirror on multiple nodes. Titles are assigned to the slices by a stable
+    hash, so all nodes compute the same partition and the slices have about
+    the same size regardless of how the titles are distributed.
+    """
+
+    def __init__(self, index: int, count: int):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index}/{count}, the index must be between 0 and {count - 1}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """Parse a shard given as 'i/N'."""
+        index, sep, count = value.partition("/")
+        if not sep or not index.isdigit() or not count.isdigit():
+            raise ValueError(f"Invalid shard '{value}', expected 'i/N'")
+        return cls(int(index), int(count))
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    @property
+    def name(self) -> str:
+        """Name of the state subdirectory of the shard."""
+        return f"shard-{self.index}-of-{self.count}"
+
+    @staticmethod
+    def hash(title: str) -> int:
+        # not hash(), which is randomized per process
+        digest = hashlib.sha1(title.replace("_", " ").encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def __contains__(self, title: str) -> bool:
+        return self.hash(title) % self.count == self.index
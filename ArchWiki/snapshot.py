@@ -0,0 +1,80 @@
+import datetime
+import gzip
+import json
+import os
+
+from .atomic import atomic_open
+from .sync import format_timestamp, parse_timestamp
+
+
+class SiteSnapshot:
+    """
+    Metadata of the wiki needed to process pages: the namespaces from the
+    siteinfo and the link index (all pages and redirects in the downloaded
+    namespaces mapped to local paths, see LinkIndex). Stored as a compressed
+    JSON file in the state directory, so that a run can start without
+    enumerating the wiki and offline operations do not need the wiki at all.
+
+    The snapshot is revalidated by applying the recent changes made since it
+    was taken, see Downloader.load_link_index.
+    """
+
+    # the recent changes must cover the whole period, see SyncState.max_age
+    max_age = datetime.timedelta(days=30)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.timestamp: datetime.datetime | None = None
+        self.config: dict = {}
+        self.namespaces: dict[int, dict] = {}
+        self.links: dict[str, tuple[str | None, str]] = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            print(f"Ignoring invalid site snapshot {self.path}")
+            return
+        self.timestamp = parse_timestamp(data["timestamp"])
+        self.config = data.get("config", {})
+        self.namespaces = {int(id_): ns for id_, ns in data.get("namespaces", {}).items()}
+        self.links = {key: (path, fragment) for key, (path, fragment) in data.get("links", {}).items()}
+
+    def save(
+        self,
+        timestamp: datetime.datetime,
+        config: dict,
+        namespaces: dict[int, dict],
+        links: dict[str, tuple[str | None, str]],
+    ) -> None:
+        self.timestamp = timestamp
+        self.config = config
+        self.namespaces = namespaces
+        self.links = links
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_open(self.path, "wt", gzip.open, encoding="utf-8") as fd:
+            json.dump(
+                {
+                    "timestamp": format_timestamp(timestamp),
+                    "config": config,
+                    "namespaces": {str(id_): ns for id_, ns in namespaces.items()},
+                    "links": links,
+                },
+                fd,
+            )
+
+    def usable(self, config: dict, now: datetime.datetime, offline: bool = False) -> bool:
+        """
+        Check if the snapshot can be used with the given configuration. Too
+        old snapshots cannot be revalidated, but they are good enough for
+        offline operations.
+        """
+        if self.timestamp is None or self.config != config:
+            return False
+        if not offline and now - self.timestamp > self.max_age:
+            return False
+        return True
@@ -0,0 +1,161 @@
+import datetime
+import json
+import os
+from collections.abc import Iterable, Iterator
+
+from ws.client.api import API
+
+from .atomic import atomic_open
+
+
+def parse_timestamp(value: str | datetime.datetime) -> datetime.datetime:
+    """Convert a MediaWiki timestamp into an aware 'datetime' object."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=datetime.UTC)
+        return value
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def format_timestamp(value: datetime.datetime) -> str:
+    """Format a 'datetime' object as a MediaWiki timestamp."""
+    return value.astimezone(datetime.UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SyncState:
+    """
+    State of the last successful synchronization, stored as a JSON file.
+    """
+
+    # recentchanges are kept for 90 days on ArchWiki, be on the safe side
+    max_age = datetime.timedelta(days=30)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.timestamp: datetime.datetime | None = None
+        self.config: dict = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            print(f"Ignoring invalid sync state {self.path}")
+            return
+        self.timestamp = parse_timestamp(data["timestamp"])
+        self.config = data.get("config", {})
+
+    def save(self, timestamp: datetime.datetime, config: dict) -> None:
+        self.timestamp = timestamp
+        self.config = config
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_open(self.path) as fd:
+            json.dump(
+                {"timestamp": format_timestamp(timestamp), "config": config},
+                fd,
+                indent=2,
+            )
+
+    def usable(
+        self, config: dict, epoch: datetime.datetime, now: datetime.datetime
+    ) -> bool:
+        """
+        Check if an incremental sync can start from this state. It cannot if
+        the state is missing or too old, if it was made with a different
+        configuration, or if the epoch requires an update of all files.
+        """
+        if self.timestamp is None:
+            return False
+        if now - self.timestamp > self.max_age:
+            return False
+        if self.timestamp < epoch:
+            return False
+        return self.config == config
+
+
+class ChangeSet:
+    """
+    Titles affected by the changes on the wiki. The titles have to be checked
+    again, because they may have been deleted or turned into redirects.
+    """
+
+    def __init__(self):
+        self.pages: set[str] = set()
+        self.images: set[str] = set()
+        self.templates: set[str] = set()
+
+
+def recent_changes(
+    api: API,
+    since: datetime.datetime,
+    until: datetime.datetime,
+    namespaces: list[str],
+    transclusions: bool = True,
+) -> ChangeSet:
+    """
+    Collect pages and images affected by edits, page creations, moves,
+    deletions and uploads between @since and @until. Unless @transclusions
+    is False, pages transcluding an edited template are included too,
+    because their rendered content changes without an entry in
+    recentchanges.
+    """
+    changes = ChangeSet()
+    # not filtered by rcnamespace, pages may be moved from other namespaces
+    rc = api.list(
+        list="recentchanges",
+        rcstart=format_timestamp(since),
+        rcend=format_timestamp(until),
+        rcdir="newer",
+        rctype="edit|new|log",
+        rcprop="title|loginfo",
+        rclimit="max",
+    )
+    for change in rc:
+        ns = str(change["ns"])
+        title = change["title"]
+        if ns == "6":
+            # only uploads and deletions matter for files
+            if change["type"] == "log":
+                changes.images.add(title)
+        elif ns == "10":
+            changes.templates.add(title)
+        elif ns in namespaces:
+            changes.pages.add(title)
+
+        # the target of a move may be in any namespace
+        if change.get("logtype") == "move":
+            target = change.get("logparams", {}).get("target_title")
+            if target is not None:
+                target_ns = str(change["logparams"].get("target_ns", ""))
+                if target_ns == "6":
+                    changes.images.add(target)
+                elif target_ns in namespaces:
+                    changes.pages.add(target)
+
+    for template in sorted(changes.templates if transclusions else ()):
+        embeddedin = api.list(
+            list="embeddedin",
+            eititle=template,
+            einamespace="|".join(namespaces),
+            eilimit="max",
+        )
+        for page in embeddedin:
+            changes.pages.add(page["title"])
+
+    return changes
+
+
+def query_titles(api: API, titles: Iterable[str], **params) -> Iterator[dict]:
+    """Query information about the given titles in batches of 50."""
+    titles = list(titles)
+    for i in range(0, len(titles), 50):
+        result = api.call_api(
+            action="query", titles="|".join(titles[i : i + 50]), **params
+        )
+        pages = result.get("pages", [])
+        if isinstance(pages, dict):
+            pages = pages.values()
+        yield from pages
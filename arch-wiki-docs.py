@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 
 import datetime
+import os
 import sys
 
 import ws.ArchWiki.lang as lang
@@ -9,9 +10,9 @@ from ws.client import API
 
 import ArchWiki
 
-def print_namespaces(api: API) -> None:
-    for id_ in sorted(api.site.namespaces.keys()):
-        ns = api.site.namespaces[id_]["*"]
+def print_namespaces(namespaces: dict[int, dict]) -> None:
+    for id_ in sorted(namespaces.keys()):
+        ns = namespaces[id_]["*"]
         if ns == "":
             ns = "Main"
         print("  %2d -- %s" % (id_, ns))
@@ -27,8 +28,47 @@ if __name__ == "__main__":
     group.add_argument("--safe-filenames", action="store_true", help="Force using ASCII file names instead of the default Unicode.")
     group.add_argument("--langs", type=str, nargs='+', help="Download only pages in these languages (specified by language tags)")
     group.add_argument("--list-langs", action="store_true", help="List supported languages")
+    group.add_argument("--incremental", action="store_true", help="Download only pages and images changed since the last run, based on the recent changes on the wiki. Falls back to a full scan when the last run is unknown or too old.")
+    group.add_argument("--reoptimize", action="store_true", help="Do not download anything, only regenerate the optimized pages from the raw HTML cache in the output directory. Uses all CPUs unless --optimizer-processes is given. Implies --offline when there is a site snapshot.")
+    group.add_argument("--offline", action="store_true", help="Do not contact the wiki, work only with the local state in the output directory: --reoptimize, --clean, --search and --pack are done without downloading anything. Links are resolved using the site snapshot saved by the previous runs.")
+    group.add_argument("--shard", type=str, metavar="I/N", help="Synchronize only the I-th of N slices of the pages and images (0 <= I < N), so that a full mirror can be synced by N nodes into a shared output directory or into separate ones which are copied together afterwards. Use --merge-shards N to finish the mirror.")
+    group.add_argument("--merge-shards", type=int, metavar="N", help="Do not download anything, combine the file lists of all N shards synced into the output directory. Use together with --clean, --search or --pack, which need the whole mirror.")
+    group.add_argument("--download-workers", type=int, default=1, help="Number of pages/images downloaded concurrently (default: %(default)s, i.e. sequential).")
+    group.add_argument("--optimizer-processes", type=int, default=0, help="Number of processes optimizing the downloaded pages (default: %(default)s, i.e. optimize in the download threads). Use together with --download-workers larger than this value.")
+    group.add_argument("--max-connections-per-host", type=int, help="Maximum number of concurrent connections to a single host (default: same as --download-workers).")
+    group.add_argument("--referenced-images", action="store_true", help="Download only the images used on the downloaded pages instead of all images on the wiki. Other images are deleted by --clean.")
+    group.add_argument("--convert-man", type=str, metavar="DIR", help="Convert each downloaded page to a man page stored in DIR, directly from the optimized page in memory (requires pandoc).")
+    group.add_argument("--convert-extra", action="append", default=[], metavar="FORMAT:DIR", help="With --convert-man, render also this pandoc output format into DIR from the same parsed page. Can be given multiple times.")
+    group.add_argument("--no-html", action="store_true", help="Do not store the optimized HTML pages, only their conversions. Requires --convert-man.")
+    group.add_argument("--optimize-images", action="store_true", help="Recompress the downloaded PNG and JPEG images losslessly (using oxipng or optipng and jpegtran, if installed) and minify the SVG images. Already processed images are skipped. Uses --optimizer-processes processes, or all CPUs.")
+    group.add_argument("--search", action="store_true", help="Maintain an offline full-text search index of the pages, which can be used by opening search/index.html in the output directory.")
+    group.add_argument("--pack", type=str, metavar="FILE", help="After downloading, pack the output directory into a single archive, which can be browsed with 'python -m ArchWiki.pack FILE'. The file must be outside of the output directory.")
+    group.add_argument("--verbose", action="store_true", help="Print a line for each processed page and image instead of the progress line.")
+    group.add_argument("--metrics-file", type=str, help="Write counters and per-stage timings of the run to this file at the end. The Prometheus textfile format is used for files with the '.prom' extension, JSON otherwise.")
 
     args = ws.config.parse_args(argparser)
+    if args.no_html and not args.convert_man:
+        argparser.error("--no-html requires --convert-man")
+    if args.convert_extra and not args.convert_man:
+        argparser.error("--convert-extra requires --convert-man")
+    if args.pack:
+        output_directory = os.path.abspath(args.output_directory)
+        if os.path.commonpath([os.path.abspath(args.pack), output_directory]) == output_directory:
+            argparser.error("--pack must not be inside the output directory")
+    shard = None
+    if args.shard:
+        try:
+            shard = ArchWiki.Shard.parse(args.shard)
+        except ValueError as e:
+            argparser.error(str(e))
+        for option in ["clean", "search", "pack", "merge_shards"]:
+            if getattr(args, option):
+                argparser.error("--{} cannot be used with --shard, use it with --merge-shards after all shards are synced".format(option.replace("_", "-")))
+        if args.referenced_images:
+            # each shard would download the images of its pages, also those of other shards
+            argparser.error("--referenced-images cannot be used with --shard")
+    if args.merge_shards is not None and args.merge_shards < 1:
+        argparser.error("--merge-shards must be a positive number")
     if args.list_langs:
         for tag in lang.get_language_tags():
             print(tag, lang.english_for_tag(tag))
@@ -42,14 +82,82 @@ if __name__ == "__main__":
 
     api = API.from_argparser(args)
     optimizer = ArchWiki.Optimizer(api, args.output_directory, args.safe_filenames, args.langs)
+    metrics = ArchWiki.Metrics(verbose=args.verbose)
 
-    downloader = ArchWiki.Downloader(api, args.output_directory, epoch, optimizer=optimizer)
-    downloader.download_css()
-    print_namespaces(api)
-    for ns in ["0", "4", "12", "14"]:
-        downloader.process_namespace(ns)
+    converter = None
+    if args.convert_man:
+        from ArchWiki.converter import Converter, ManFilter, MultiFormatConverter
+        if args.convert_extra:
+            outputs = {"man": args.convert_man}
+            for spec in args.convert_extra:
+                output_format, _, output_dir = spec.partition(":")
+                if not output_dir:
+                    argparser.error("--convert-extra must be given as FORMAT:DIR")
+                outputs[output_format] = output_dir
+            filters = {output_format: ManFilter() for output_format in outputs}
+            converter = MultiFormatConverter(filters, args.output_directory, outputs, verbose=args.verbose)
+        else:
+            converter = Converter(ManFilter(), args.output_directory, args.convert_man, "man", verbose=args.verbose)
 
-    downloader.download_images()
+    downloader = ArchWiki.Downloader(api, args.output_directory, epoch, optimizer=optimizer,
+                                     workers=args.download_workers,
+                                     max_per_host=args.max_connections_per_host,
+                                     optimizer_processes=args.optimizer_processes,
+                                     metrics=metrics,
+                                     search=args.search,
+                                     referenced_images=args.referenced_images,
+                                     converter=converter,
+                                     write_html=not args.no_html,
+                                     offline=args.offline,
+                                     shard=shard,
+                                     image_optimization=args.optimize_images)
+    try:
+        if args.reoptimize or args.offline or args.merge_shards:
+            if args.merge_shards:
+                downloader.merge_shards(args.merge_shards)
+            if args.reoptimize:
+                downloader.reoptimize()
+            if args.optimize_images:
+                downloader.optimize_images()
+            if args.clean:
+                downloader.clean_output_directory()
+            if args.search:
+                downloader.update_search_index()
+            downloader.save_snapshot()
+            if args.pack:
+                downloader.write_pack(args.pack)
+            downloader.close()
+            sys.exit()
 
-    if args.clean:
-        downloader.clean_output_directory()
+        namespaces = ["0", "4", "12", "14"]
+        downloader.download_css()
+        print_namespaces(downloader.namespaces())
+        if args.incremental and downloader.sync_incremental(namespaces, clean=args.clean):
+            # deleted and moved pages were handled incrementally
+            pass
+        else:
+            for ns in namespaces:
+                downloader.process_namespace(ns)
+
+            downloader.download_images()
+            downloader.prune_manifest()
+
+        if args.optimize_images:
+            downloader.optimize_images()
+
+        if args.clean:
+            downloader.clean_output_directory()
+
+        if args.search:
+            downloader.update_search_index()
+        downloader.report_changes()
+        downloader.save_sync_state()
+        downloader.save_snapshot()
+        if args.pack:
+            downloader.write_pack(args.pack)
+        downloader.close()
+    finally:
+        # record the metrics also for failed runs
+        metrics.report()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+
+"""
+Compare the link rewriting in Optimizer.update_links using the link index
+with the per-link resolution (redirect lookup and title parsing for every
+link). Pages are read from an output directory of arch-wiki-docs.py.
+"""
+
+import os
+import sys
+import time
+
+import lxml.html
+import ws.config
+from ws.client import API
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import ArchWiki  # noqa: E402
+
+
+class UncachedLinkIndex(ArchWiki.LinkIndex):
+    """Link index which resolves every link again, like before the index existed."""
+
+    def resolve(self, title):
+        return self.compute(title)
+
+
+def time_update_links(optimizer, pages):
+    start = time.perf_counter()
+    for fname, html in pages:
+        root = lxml.html.document_fromstring(html)
+        relbase = os.path.relpath(optimizer.base_directory, os.path.dirname(fname))
+        optimizer.update_links(root, relbase)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    argparser = ws.config.getArgParser(description="Benchmark the link index of the optimizer")
+    API.set_argparser(argparser)
+    group = argparser.add_argument_group(title="benchmark parameters")
+    group.add_argument("--output-directory", type=str, required=True, help="Output directory of arch-wiki-docs.py with downloaded pages.")
+    group.add_argument("--pages", type=int, default=100, help="Number of pages to process (default: %(default)s).")
+    args = ws.config.parse_args(argparser)
+
+    pages = []
+    for path, dirs, files in os.walk(args.output_directory):
+        for f in sorted(files):
+            if f.endswith(".html") and len(pages) < args.pages:
+                fname = os.path.join(path, f)
+                with open(fname) as fd:
+                    pages.append((fname, fd.read()))
+    links = sum(html.count("<a ") for fname, html in pages)
+    print(f"{len(pages)} pages, {links} links")
+
+    api = API.from_argparser(args)
+    # fetch the redirects before timing anything
+    api.redirects.resolve("Main page")
+
+    optimizer = ArchWiki.Optimizer(api, args.output_directory)
+    optimizer.link_index = UncachedLinkIndex(optimizer)
+    uncached = time_update_links(optimizer, pages)
+    print(f"per-link resolution:   {uncached:.3f} s")
+
+    optimizer = ArchWiki.Optimizer(api, args.output_directory)
+    start = time.perf_counter()
+    optimizer.link_index.build()
+    build = time.perf_counter() - start
+    indexed = time_update_links(optimizer, pages)
+    print(f"link index (build):    {build:.3f} s")
+    print(f"link index (rewrite):  {indexed:.3f} s")
+    print(f"speedup of rewriting:  {uncached / indexed:.1f}x")
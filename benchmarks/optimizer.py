@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+
+"""
+Check that the single-pass Optimizer.optimize produces output identical to
+the multi-pass reference implementation and compare their speed. The corpus
+is a directory of raw HTML pages (*.html or *.html.gz), by default the raw
+HTML cache of an output directory of arch-wiki-docs.py.
+"""
+
+import gzip
+import os
+import sys
+import time
+
+import ws.config
+from ws.client import API
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import ArchWiki  # noqa: E402
+
+
+def load_corpus(corpus, base_directory):
+    pages = []
+    for path, dirs, files in os.walk(corpus):
+        for f in sorted(files):
+            fpath = os.path.join(path, f)
+            if f.endswith(".html.gz"):
+                with gzip.open(fpath, "rt", encoding="utf-8") as fd:
+                    html = fd.read()
+                f = f[:-3]
+            elif f.endswith(".html"):
+                with open(fpath) as fd:
+                    html = fd.read()
+            else:
+                continue
+            # file name of the optimized page, determines the relative links
+            fname = os.path.join(base_directory, os.path.relpath(path, corpus), f)
+            pages.append((os.path.normpath(fname), html))
+    return pages
+
+
+def run(method, pages):
+    outputs = []
+    start = time.perf_counter()
+    for fname, html in pages:
+        outputs.append(method(fname, html))
+    return time.perf_counter() - start, outputs
+
+
+if __name__ == "__main__":
+    argparser = ws.config.getArgParser(description="Check and benchmark the single-pass optimizer")
+    API.set_argparser(argparser)
+    group = argparser.add_argument_group(title="benchmark parameters")
+    group.add_argument("--output-directory", type=str, required=True, help="Output directory of arch-wiki-docs.py.")
+    group.add_argument("--corpus", type=str, help="Directory with raw HTML pages (default: the raw HTML cache in the output directory).")
+    args = ws.config.parse_args(argparser)
+
+    corpus = args.corpus or os.path.join(args.output_directory, ArchWiki.Downloader.state_dirname, "raw")
+    pages = load_corpus(corpus, args.output_directory)
+    print(f"{len(pages)} pages")
+
+    api = API.from_argparser(args)
+    optimizer = ArchWiki.Optimizer(api, args.output_directory)
+    # resolve all links before timing anything
+    optimizer.link_index.build()
+
+    multipass, expected = run(optimizer.optimize_multipass, pages)
+    singlepass, actual = run(optimizer.optimize, pages)
+
+    mismatches = [fname for (fname, html), a, b in zip(pages, expected, actual) if a != b]
+    for fname in mismatches:
+        print(f"  [mismatch]    {fname}")
+
+    print(f"multi-pass:  {multipass:.3f} s")
+    print(f"single-pass: {singlepass:.3f} s")
+    if singlepass > 0:
+        print(f"speedup:     {multipass / singlepass:.1f}x")
+    sys.exit(1 if mismatches else 0)
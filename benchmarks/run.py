@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+
+"""
+End-to-end benchmark of arch-wiki-docs against the local stand-in server
+(see server.py). For each corpus size it measures the download of pages
+(Downloader.process_namespace) and images (Downloader.download_images),
+the optimization of the downloaded pages (Optimizer.optimize, compared with
+the multi-pass reference implementation) and the conversion to man pages
+(Converter.convert_file, only if pandoc is installed). The results are
+written as JSON so that they can be compared between versions.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from ws.client import API
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ArchWiki  # noqa: E402
+from ArchWiki.converter import Converter, ManFilter  # noqa: E402
+
+from server import FakeWikiServer, Wiki  # noqa: E402
+
+NAMESPACES = ["0", "14"]
+
+
+@contextlib.contextmanager
+def quiet():
+    """Suppress the per-page output of the benchmarked code."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    with quiet():
+        fn(*args)
+    return time.perf_counter() - start
+
+
+def benchmark(size, args):
+    server = FakeWikiServer(Wiki(size), args.latency).start()
+    result = {"size": size}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "wiki")
+            api = API(server.api_url, server.index_url, API.make_session())
+            optimizer = ArchWiki.Optimizer(api, output)
+            metrics = ArchWiki.Metrics(progress=False)
+            downloader = ArchWiki.Downloader(
+                api,
+                output,
+                epoch=datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC),
+                optimizer=optimizer,
+                workers=args.workers,
+                optimizer_processes=args.optimizer_processes,
+                metrics=metrics,
+            )
+
+            result["process_namespace"] = sum(
+                timed(downloader.process_namespace, ns) for ns in NAMESPACES
+            )
+            result["download_images"] = timed(downloader.download_images)
+            result["requests"] = server.requests
+            result["download_metrics"] = metrics.as_dict()
+
+            # second run, everything is up-to-date
+            result["process_namespace_noop"] = sum(
+                timed(downloader.process_namespace, ns) for ns in NAMESPACES
+            )
+
+            pages = []
+            for title, fname, timestamp, revid in downloader.manifest.files("page"):
+                pages.append((fname, downloader.raw_cache.load(fname)))
+            result["pages"] = len(pages)
+            downloader.close()
+
+            start = time.perf_counter()
+            expected = [optimizer.optimize_multipass(fname, html) for fname, html in pages]
+            result["optimize_multipass"] = time.perf_counter() - start
+            start = time.perf_counter()
+            actual = [optimizer.optimize(fname, html) for fname, html in pages]
+            result["optimize"] = time.perf_counter() - start
+            result["optimize_identical"] = expected == actual
+
+            if shutil.which("pandoc"):
+                converter = Converter(ManFilter(), output, os.path.join(tmp, "man"), "man")
+                start = time.perf_counter()
+                with quiet():
+                    for fname, html in pages:
+                        converter.convert_file(fname, converter.get_output_filename(fname))
+                result["convert_file"] = time.perf_counter() - start
+                result["convert_stages"] = converter.timings
+            else:
+                result["convert_file"] = None
+    finally:
+        server.shutdown()
+        server.server_close()
+    return result
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark arch-wiki-docs against a local stand-in wiki")
+    argparser.add_argument("--sizes", type=int, nargs="+", default=[30, 300, 3000], help="Numbers of pages to benchmark (default: %(default)s).")
+    argparser.add_argument("--latency", type=float, default=0.01, help="Delay of each server response in seconds (default: %(default)s).")
+    argparser.add_argument("--workers", type=int, default=1, help="Number of download workers (default: %(default)s).")
+    argparser.add_argument("--optimizer-processes", type=int, default=0, help="Number of optimizer processes (default: %(default)s).")
+    argparser.add_argument("--output", type=str, help="Write the JSON results to this file instead of stdout.")
+    args = argparser.parse_args()
+
+    report = {
+        "version": ArchWiki.__version__,
+        "python": platform.python_version(),
+        "date": datetime.datetime.now(datetime.UTC).isoformat(),
+        "parameters": {
+            "latency": args.latency,
+            "workers": args.workers,
+            "optimizer_processes": args.optimizer_processes,
+        },
+        "results": [],
+    }
+    for size in args.sizes:
+        print(f"Benchmarking {size} pages...", file=sys.stderr)
+        report["results"].append(benchmark(size, args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if not all(r["optimize_identical"] for r in report["results"]):
+        sys.exit("single-pass optimizer output differs from the multi-pass implementation")
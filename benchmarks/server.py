@@ -0,0 +1,575 @@
+#! /usr/bin/env python3
+
+"""
+Local stand-in for the ArchWiki web server. It implements the parts of the
+MediaWiki API used by arch-wiki-docs (siteinfo, allpages with redirect
+filtering, allimages, page info with redirect resolution and
+recentchanges), serves the pages of the benchmark corpus under /title/
+(redirects serve their targets) and the images under /images/. Responses
+support conditional and range requests and can be delayed to simulate
+network latency. For tests, requests can be rejected on demand (see
+FakeWikiServer.fail), the number of concurrent requests is tracked and the
+wiki can be changed (see Wiki.edit, Wiki.move, Wiki.delete and Wiki.upload).
+
+The corpus is scaled to the requested number of pages by repeating the
+pages with numbered titles; images and the redirects in REDIRECTS are
+repeated in the same ratio.
+"""
+
+import argparse
+import datetime
+import email.utils
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+TIMESTAMP = datetime.datetime(2026, 1, 1, tzinfo=datetime.UTC)
+
+NAMESPACES = {
+    -2: "Media",
+    -1: "Special",
+    0: "",
+    1: "Talk",
+    2: "User",
+    3: "User talk",
+    4: "ArchWiki",
+    5: "ArchWiki talk",
+    6: "File",
+    7: "File talk",
+    8: "MediaWiki",
+    9: "MediaWiki talk",
+    10: "Template",
+    11: "Template talk",
+    12: "Help",
+    13: "Help talk",
+    14: "Category",
+    15: "Category talk",
+}
+
+INTERWIKI = {
+    "de": "https://wiki.archlinux.de/title/$1",
+    "fr": "https://wiki.archlinux.fr/$1",
+    "ja": "https://wiki.archlinux.jp/index.php/$1",
+    "wikipedia": "https://en.wikipedia.org/wiki/$1",
+}
+
+LEGALTITLECHARS = r""" %!"$&'()*,\-.\/0-9:;=?@A-Z\\^_`a-z~\x80-\xFF+"""
+
+CSS = b"body { font-family: sans-serif; }\n"
+
+
+# redirects of the corpus: title -> (target, fragment); some of them are linked
+# from the corpus pages
+REDIRECTS = {
+    "Installation guides": ("Installation guide", "Pre-installation"),
+    "Table of contents": ("Category:Installation process", ""),
+    "Install": ("Installation guide", "Installation"),
+}
+
+
+def format_timestamp(timestamp):
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def split_language(title):
+    """Split the language suffix of a title, e.g. ' (Espanol)'."""
+    match = re.match(r"^(.*?)( \([^()]+\))?$", title)
+    return match.group(1), match.group(2) or ""
+
+
+def file_name(title):
+    """Name of the image of a 'File:' title."""
+    return title[len("File:"):].replace(" ", "_")
+
+
+class Wiki:
+    def __init__(self, size, corpus=CORPUS):
+        self.base_url = ""
+        templates = []
+        pages_dir = os.path.join(corpus, "pages")
+        for f in sorted(os.listdir(pages_dir)):
+            with open(os.path.join(pages_dir, f), encoding="utf-8") as fd:
+                templates.append((f[:-5].replace("_", " "), fd.read()))
+        images = []
+        images_dir = os.path.join(corpus, "images")
+        for f in sorted(os.listdir(images_dir)):
+            with open(os.path.join(images_dir, f), "rb") as fd:
+                images.append((f, fd.read()))
+
+        # title -> (pageid, namespace, html)
+        self.pages = {}
+        for i in range(size):
+            title, html = templates[i % len(templates)]
+            copy = i // len(templates)
+            if copy > 0:
+                name, lang = split_language(title)
+                title = f"{name} {copy}{lang}"
+            ns = 14 if title.startswith("Category:") else 0
+            self.pages[title] = (i + 1, ns, html)
+
+        # file name -> (pageid, content)
+        self.images = {}
+        copies = max(size // len(templates), 1)
+        for copy in range(copies):
+            for name, content in images:
+                if copy > 0:
+                    stem, ext = os.path.splitext(name)
+                    name = f"{stem}-{copy}{ext}"
+                self.images[name] = (size + len(self.images) + 1, content)
+
+        # title -> (pageid, namespace, target, fragment)
+        self.redirects = {}
+        for copy in range(copies):
+            for title, (target, fragment) in REDIRECTS.items():
+                if copy > 0:
+                    title = f"{title} {copy}"
+                    name, lang = split_language(target)
+                    target = f"{name} {copy}{lang}"
+                if target not in self.pages:
+                    continue
+                pageid = size + len(self.images) + len(self.redirects) + 1
+                ns = 14 if title.startswith("Category:") else 0
+                self.redirects[title] = (pageid, ns, target, fragment)
+
+        # the ids of new pages and revisions continue after the corpus
+        self.last_pageid = size + len(self.images) + len(self.redirects)
+        self.last_revid = 1000 + self.last_pageid
+        # title -> (revid, timestamp) of the pages and files changed since
+        # the start of the server
+        self.revisions = {}
+        # entries of list=recentchanges, oldest first
+        self.changes = []
+
+    def revision(self, title, pageid):
+        return self.revisions.get(title, (1000 + pageid, TIMESTAMP))
+
+    def record_change(self, title, ns, type_="log", **params):
+        """Create a new revision of @title and add an entry to recentchanges."""
+        self.last_revid += 1
+        timestamp = datetime.datetime.now(datetime.UTC)
+        self.revisions[title] = (self.last_revid, timestamp)
+        self.changes.append(
+            dict(type=type_, ns=ns, title=title, timestamp=format_timestamp(timestamp), **params)
+        )
+
+    def edit(self, title, html):
+        pageid, ns, _ = self.pages[title]
+        self.pages[title] = (pageid, ns, html)
+        self.record_change(title, ns, "edit")
+
+    def move(self, title, target):
+        """Move a page or an image, moved pages leave a redirect behind."""
+        if title.startswith("File:"):
+            ns = target_ns = 6
+            self.images[file_name(target)] = self.images.pop(file_name(title))
+        else:
+            pageid, ns, html = self.pages.pop(title)
+            target_ns = 14 if target.startswith("Category:") else 0
+            self.pages[target] = (pageid, target_ns, html)
+            self.last_pageid += 1
+            self.redirects[title] = (self.last_pageid, ns, target, "")
+        self.revisions[target] = self.revision(title, 0)
+        params = {"target_ns": target_ns, "target_title": target}
+        self.record_change(title, ns, logtype="move", logaction="move", logparams=params)
+
+    def delete(self, title):
+        if title.startswith("File:"):
+            ns = 6
+            del self.images[file_name(title)]
+        else:
+            ns = self.pages.pop(title)[1]
+        self.record_change(title, ns, logtype="delete", logaction="delete")
+
+    def upload(self, name, content):
+        if name in self.images:
+            action = "overwrite"
+            self.images[name] = (self.images[name][0], content)
+        else:
+            action = "upload"
+            self.last_pageid += 1
+            self.images[name] = (self.last_pageid, content)
+        title = "File:" + name.replace("_", " ")
+        self.record_change(title, 6, logtype="upload", logaction=action)
+
+    def recent_changes(self, params):
+        start = params.get("rcstart", "")
+        end = params.get("rcend", "9999")
+        changes = [change for change in self.changes if start <= change["timestamp"] <= end]
+        if params.get("rcdir", "older") == "older":
+            changes.reverse()
+        return changes
+
+    def page_url(self, title):
+        return self.base_url + "/title/" + urllib.parse.quote(title.replace(" ", "_"))
+
+    def image_url(self, name):
+        return self.base_url + "/images/" + urllib.parse.quote(name)
+
+    def page_info(self, title):
+        if title in self.redirects:
+            pageid, ns, target, fragment = self.redirects[title]
+            return {
+                "pageid": pageid,
+                "ns": ns,
+                "title": title,
+                "redirect": True,
+                "touched": format_timestamp(self.revision(title, pageid)[1]),
+                "lastrevid": self.revision(title, pageid)[0],
+                "length": len(target),
+                "fullurl": self.page_url(title),
+            }
+        pageid, ns, html = self.pages[title]
+        return {
+            "pageid": pageid,
+            "ns": ns,
+            "title": title,
+            "touched": format_timestamp(self.revision(title, pageid)[1]),
+            "lastrevid": self.revision(title, pageid)[0],
+            "length": len(html),
+            "fullurl": self.page_url(title),
+        }
+
+    def image_info(self, name):
+        pageid, content = self.images[name]
+        title = "File:" + name.replace("_", " ")
+        return {
+            "pageid": pageid,
+            "ns": 6,
+            "name": name,
+            "title": title,
+            "url": self.image_url(name),
+            "timestamp": format_timestamp(self.revision(title, pageid)[1]),
+            "size": len(content),
+        }
+
+    def siteinfo(self, props):
+        result = {}
+        if "general" in props:
+            result["general"] = {
+                "mainpage": "Main page",
+                "base": self.base_url + "/title/Main_page",
+                "sitename": "ArchWiki",
+                "generator": "MediaWiki 1.41.1",
+                "case": "first-letter",
+                "lang": "en",
+                "server": self.base_url,
+                "articlepath": "/title/$1",
+                "scriptpath": "",
+                "script": "/index.php",
+                "wikiid": "archwiki",
+                "legaltitlechars": LEGALTITLECHARS,
+                "invalidusernamechars": "@:",
+                "time": datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+        if "namespaces" in props:
+            result["namespaces"] = {
+                str(id_): {
+                    "id": id_,
+                    "case": "first-letter",
+                    "name": name,
+                    "*": name,
+                    "canonical": name,
+                    "subpages": id_ not in (0, 6, 14),
+                    "content": id_ == 0,
+                    "nonincludable": False,
+                }
+                for id_, name in NAMESPACES.items()
+            }
+        if "namespacealiases" in props:
+            result["namespacealiases"] = [{"id": 4, "alias": "Project", "*": "Project"}]
+        if "interwikimap" in props:
+            result["interwikimap"] = [
+                {"prefix": prefix, "local": prefix != "wikipedia", "url": url}
+                for prefix, url in INTERWIKI.items()
+            ]
+        for prop in props:
+            result.setdefault(prop, [])
+        return result
+
+    def titles(self, ns, filterredir):
+        """Titles of pages and redirects in @ns, filtered like the 'filterredir' parameter."""
+        titles = []
+        if filterredir != "redirects":
+            titles += [title for title, (pageid, ns_, html) in self.pages.items() if ns_ == ns]
+        if filterredir not in ("nonredirects", None):
+            titles += [title for title, (pageid, ns_, *_) in self.redirects.items() if ns_ == ns]
+        return titles
+
+    def resolve_redirects(self, titles):
+        """Replace redirects by their targets, like the 'redirects' parameter."""
+        resolved = []
+        redirects = []
+        for title in titles:
+            if title in self.redirects:
+                pageid, ns, target, fragment = self.redirects[title]
+                entry = {"from": title, "to": target}
+                if fragment:
+                    entry["tofragment"] = fragment
+                redirects.append(entry)
+                title = target
+            if title not in resolved:
+                resolved.append(title)
+        return resolved, redirects
+
+    def query(self, params):
+        """Handle action=query, return the 'query' part of the result."""
+        result = {}
+        if "meta" in params and "siteinfo" in params["meta"].split("|"):
+            result.update(self.siteinfo(params.get("siprop", "general").split("|")))
+
+        lists = params.get("list", "").split("|") if params.get("list") else []
+        for list_ in lists:
+            if list_ == "allpages":
+                ns = int(params.get("apnamespace", 0))
+                result["allpages"] = [
+                    {"pageid": self.page_info(title)["pageid"], "ns": ns, "title": title}
+                    for title in self.titles(ns, params.get("apfilterredir", "all"))
+                ]
+            elif list_ == "allimages":
+                result["allimages"] = [self.image_info(name) for name in self.images]
+            elif list_ == "recentchanges":
+                result["recentchanges"] = self.recent_changes(params)
+            else:
+                # embeddedin, allredirects, ...
+                result[list_] = []
+
+        titles = []
+        generator = params.get("generator")
+        if generator == "allpages":
+            ns = int(params.get("gapnamespace", 0))
+            titles = self.titles(ns, params.get("gapfilterredir", "all"))
+        elif generator is None and "titles" in params:
+            titles = [title.replace("_", " ") for title in params["titles"].split("|")]
+            normalized = [
+                {"from": title, "to": title.replace("_", " ")}
+                for title in params["titles"].split("|")
+                if "_" in title
+            ]
+            if normalized:
+                result["normalized"] = normalized
+        if "redirects" in params and params["redirects"] not in ("0", "false"):
+            titles, redirects = self.resolve_redirects(titles)
+            if redirects:
+                result["redirects"] = redirects
+        if generator is not None or "titles" in params:
+            pages = []
+            for title in titles:
+                if title in self.pages or title in self.redirects:
+                    pages.append(self.page_info(title))
+                elif title.startswith("File:") and file_name(title) in self.images:
+                    info = self.image_info(file_name(title))
+                    pages.append(
+                        {
+                            "pageid": info["pageid"],
+                            "ns": 6,
+                            "title": info["title"],
+                            "imageinfo": [info],
+                        }
+                    )
+                else:
+                    pages.append({"ns": 0, "title": title, "missing": True})
+            result["pages"] = pages
+        return result
+
+    def api(self, params):
+        if params.get("action") != "query":
+            return {"batchcomplete": True}
+        result = {"batchcomplete": True, "query": self.query(params)}
+        if params.get("formatversion") != "2":
+            result = to_formatversion1(result)
+        return result
+
+
+def to_formatversion1(value, key=None):
+    """Convert booleans and page lists of a formatversion=2 result."""
+    if isinstance(value, dict):
+        converted = {}
+        for k, v in value.items():
+            if v is True:
+                converted[k] = ""
+            elif v is False:
+                continue
+            else:
+                converted[k] = to_formatversion1(v, k)
+        return converted
+    if isinstance(value, list):
+        if key == "pages":
+            return {
+                str(page.get("pageid", -i - 1)): to_formatversion1(page)
+                for i, page in enumerate(value)
+            }
+        return [to_formatversion1(v) for v in value]
+    return value
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            time.sleep(self.server.latency)
+            self.dispatch()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def dispatch(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if self.command == "POST":
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode("utf-8")
+            params.update(urllib.parse.parse_qsl(body))
+
+        wiki = self.server.wiki
+        path = urllib.parse.unquote(url.path)
+        failure = self.server.take_failure(path)
+        if failure is not None:
+            status, headers = failure
+            self.send_body(b"", "text/plain", status, headers)
+        elif path == "/api.php":
+            body = json.dumps(wiki.api(params)).encode("utf-8")
+            self.send_body(body, "application/json; charset=utf-8")
+        elif path.startswith("/title/"):
+            title = path[len("/title/"):].replace("_", " ")
+            if title in wiki.redirects:
+                # like MediaWiki, show the target in place of the redirect
+                title = wiki.redirects[title][2]
+            if title not in wiki.pages:
+                self.send_error(404)
+                return
+            pageid, ns, html = wiki.pages[title]
+            revid, timestamp = wiki.revision(title, pageid)
+            self.send_file(html.encode("utf-8"), "text/html; charset=UTF-8", f'"rev-{revid}"', timestamp)
+        elif path.startswith("/images/"):
+            name = path[len("/images/"):]
+            if name not in wiki.images:
+                self.send_error(404)
+                return
+            pageid, content = wiki.images[name]
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            content_type = "image/svg+xml" if name.endswith(".svg") else "image/png"
+            timestamp = wiki.revision("File:" + name.replace("_", " "), pageid)[1]
+            self.send_file(content, content_type, etag, timestamp)
+        elif path == "/load.php":
+            self.send_body(CSS, "text/css; charset=utf-8")
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, content, content_type, etag, timestamp):
+        last_modified = email.utils.format_datetime(timestamp, usegmt=True)
+        headers = {"ETag": etag, "Last-Modified": last_modified, "Accept-Ranges": "bytes"}
+
+        if self.headers.get("If-None-Match") == etag or (
+            "If-None-Match" not in self.headers
+            and self.headers.get("If-Modified-Since") == last_modified
+        ):
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        range_ = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_ and (if_range is None or if_range in (etag, last_modified)):
+            match = re.fullmatch(r"bytes=(\d+)-", range_)
+            start = int(match.group(1)) if match else len(content)
+            if start >= len(content):
+                headers["Content-Range"] = f"bytes */{len(content)}"
+                self.send_body(b"", content_type, 416, headers)
+                return
+            headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+            self.send_body(content[start:], content_type, 206, headers)
+            return
+
+        self.send_body(content, content_type, headers=headers)
+
+
+class FakeWikiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, wiki, latency=0.0, address=("127.0.0.1", 0)):
+        super().__init__(address, Handler)
+        self.wiki = wiki
+        self.latency = latency
+        self.requests = 0
+        # requests being handled now and the maximum so far
+        self.active = 0
+        self.max_active = 0
+        # path -> [remaining count, status, headers], see fail()
+        self.failures = {}
+        self.lock = threading.Lock()
+        host, port = self.server_address[:2]
+        wiki.base_url = f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        return self.wiki.base_url + "/api.php"
+
+    @property
+    def index_url(self):
+        return self.wiki.base_url + "/index.php"
+
+    def fail(self, path, count, status=429, headers=None):
+        """Reject the next @count requests of @path with @status and @headers."""
+        with self.lock:
+            self.failures[path] = [count, status, headers or {}]
+
+    def take_failure(self, path):
+        """Return the status and headers of a rejection of @path, if one is due."""
+        with self.lock:
+            failure = self.failures.get(path)
+            if failure is None or failure[0] == 0:
+                return None
+            failure[0] -= 1
+            return failure[1], failure[2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Run a local stand-in for the ArchWiki server")
+    argparser.add_argument("--size", type=int, default=100, help="Number of pages (default: %(default)s).")
+    argparser.add_argument("--latency", type=float, default=0.0, help="Delay of each response in seconds (default: %(default)s).")
+    argparser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: %(default)s).")
+    args = argparser.parse_args()
+
+    server = FakeWikiServer(Wiki(args.size), args.latency, ("127.0.0.1", args.port))
+    print(f"Serving {len(server.wiki.pages)} pages and {len(server.wiki.images)} images")
+    print(f"API URL:   {server.api_url}")
+    print(f"Index URL: {server.index_url}")
+    server.serve_forever()
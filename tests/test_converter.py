@@ -0,0 +1,41 @@
+"""
+Tests of the conversion of the optimized pages, they need pandoc.
+"""
+
+import os
+import shutil
+
+import pytest
+
+import ArchWiki
+from ArchWiki.converter import ManFilter, MultiFormatConverter
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+# optimized pages, see test_optimizer.py
+GOLDEN = os.path.join(TESTS, "golden")
+
+pytestmark = pytest.mark.skipif(shutil.which("pandoc") is None, reason="pandoc is not installed")
+
+
+def test_multiple_formats(tmp_path):
+    input_dir = tmp_path / "wiki"
+    (input_dir / "en").mkdir(parents=True)
+    shutil.copy(os.path.join(GOLDEN, "Installation_guide.html"), input_dir / "en")
+    outputs = {"man": str(tmp_path / "man"), "gfm": str(tmp_path / "md")}
+    converter = MultiFormatConverter(
+        {output_format: ManFilter() for output_format in outputs}, str(input_dir), outputs
+    )
+    metrics = ArchWiki.Metrics(progress=False)
+    converter.convert(metrics)
+
+    assert metrics.counters["errors"] == 0
+    assert metrics.counters["pages_converted"] == 1
+    with open(tmp_path / "man" / "en" / "Installation_guide.man") as fd:
+        man = fd.read()
+    with open(tmp_path / "md" / "en" / "Installation_guide.md") as fd:
+        markdown = fd.read()
+    assert ".SH" in man
+    assert "# " in markdown
+    # links between pages lose the .html suffix
+    assert "General_recommendations.html" not in markdown
+    assert "General_recommendations" in markdown
@@ -0,0 +1,285 @@
+"""
+Tests of the downloads against the stand-in wiki server of the benchmarks:
+retries of rejected requests, the bound on concurrent work and the
+resumption and deduplication of images, the resolution of redirects, the
+incremental synchronization and the offline re-optimization.
+"""
+
+import datetime
+import os
+import time
+
+import pytest
+import requests
+from ws.client import API
+
+import ArchWiki
+from server import FakeWikiServer, Wiki
+
+EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC)
+IMAGE = "Archlinux-boot-menu.png"
+
+
+@pytest.fixture
+def server():
+    # 6 pages, so that every image of the corpus has an identical copy
+    server = FakeWikiServer(Wiki(6)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_downloader(server, output, downloader_class=ArchWiki.Downloader, **kwargs):
+    api = API(server.api_url, server.index_url, API.make_session())
+    return downloader_class(
+        api,
+        output,
+        epoch=EPOCH,
+        optimizer=ArchWiki.Optimizer(api, output),
+        metrics=ArchWiki.Metrics(progress=False),
+        **kwargs,
+    )
+
+
+def image_path(output, name):
+    return os.path.join(output, "File:" + name)
+
+
+def test_retry_after(server, tmp_path):
+    output = str(tmp_path)
+    server.fail("/images/" + IMAGE, 1, 429, {"Retry-After": "1"})
+    downloader = make_downloader(server, output)
+    start = time.perf_counter()
+    downloader.download_images()
+    elapsed = time.perf_counter() - start
+    downloader.close()
+
+    assert downloader.metrics.counters["retries"] == 1
+    assert elapsed >= 1
+    with open(image_path(output, IMAGE), "rb") as fd:
+        assert fd.read() == server.wiki.images[IMAGE][1]
+
+
+def test_retry_exhausted(server, tmp_path):
+    output = str(tmp_path)
+    server.fail("/images/" + IMAGE, 3, 503, {"Retry-After": "0"})
+    downloader = make_downloader(server, output, max_retries=2)
+    with pytest.raises(requests.HTTPError):
+        downloader.download_images()
+    downloader.close()
+
+    assert downloader.metrics.counters["retries"] == 2
+    assert not os.path.exists(image_path(output, IMAGE))
+    assert downloader.cache.validators(server.wiki.image_url(IMAGE)) == {}
+
+
+def test_bounded_in_flight(tmp_path):
+    workers = 3
+    in_flight = []
+
+    class RecordingDownloader(ArchWiki.Downloader):
+        def _submit(self, fn, *args):
+            super()._submit(fn, *args)
+            with self._lock:
+                in_flight.append(len(self._pending))
+
+    server = FakeWikiServer(Wiki(30), latency=0.02).start()
+    try:
+        downloader = make_downloader(server, str(tmp_path), RecordingDownloader, workers=workers)
+        downloader.process_namespace("0")
+        downloader.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert downloader.metrics.counters["pages_downloaded"] == 20
+    assert 1 < max(in_flight) <= 2 * workers
+    # the workers plus the enumeration in the main thread
+    assert 1 < server.max_active <= workers + 1
+
+
+def test_range_resume(server, tmp_path):
+    output = str(tmp_path)
+    content = server.wiki.images[IMAGE][1]
+    url = server.wiki.image_url(IMAGE)
+    fname = image_path(output, IMAGE)
+
+    downloader = make_downloader(server, output)
+    # an interrupted download: the first part of the file and its validators
+    downloader.cache.store(url, requests.get(url), partial=True)
+    with open(fname + ".part", "wb") as fd:
+        fd.write(content[:100])
+    downloader.download_images()
+    downloader.close()
+
+    assert downloader.metrics.counters["images_resumed"] == 1
+    with open(fname, "rb") as fd:
+        assert fd.read() == content
+    assert not os.path.exists(fname + ".part")
+    assert downloader.cache.validators(url, partial=True) == {}
+    assert downloader.cache.validators(url) != {}
+
+
+def test_partial_without_validators(server, tmp_path):
+    output = str(tmp_path)
+    content = server.wiki.images[IMAGE][1]
+    fname = image_path(output, IMAGE)
+
+    downloader = make_downloader(server, output)
+    with open(fname + ".part", "wb") as fd:
+        fd.write(b"garbage")
+    downloader.download_images()
+    downloader.close()
+
+    assert downloader.metrics.counters["images_resumed"] == 0
+    with open(fname, "rb") as fd:
+        assert fd.read() == content
+
+
+def test_range_not_satisfiable(server, tmp_path):
+    output = str(tmp_path)
+    content = server.wiki.images[IMAGE][1]
+    url = server.wiki.image_url(IMAGE)
+    fname = image_path(output, IMAGE)
+
+    downloader = make_downloader(server, output)
+    downloader.cache.store(url, requests.get(url), partial=True)
+    # the partial file is not shorter than the image, the server replies 416
+    with open(fname + ".part", "wb") as fd:
+        fd.write(content + b"garbage")
+    downloader.download_images()
+    downloader.close()
+
+    assert downloader.metrics.counters["images_resumed"] == 0
+    with open(fname, "rb") as fd:
+        assert fd.read() == content
+
+
+def test_hardlink_dedup(server, tmp_path):
+    output = str(tmp_path)
+    downloader = make_downloader(server, output)
+    downloader.download_images()
+    downloader.close()
+
+    stem, ext = os.path.splitext(IMAGE)
+    original = os.stat(image_path(output, IMAGE))
+    copy = os.stat(image_path(output, f"{stem}-1{ext}"))
+    assert original.st_ino == copy.st_ino
+    assert downloader.metrics.counters["images_deduplicated"] == len(server.wiki.images) // 2
+
+
+def sync(server, output, **kwargs):
+    downloader = make_downloader(server, output, **kwargs)
+    for ns in ["0", "14"]:
+        downloader.process_namespace(ns)
+    downloader.download_images()
+    paths = {os.path.relpath(path, output) for path in downloader.manifest.paths()}
+    downloader.close()
+    return paths
+
+
+def test_merge_shards(server, tmp_path):
+    expected = sync(server, str(tmp_path / "full"))
+
+    output = str(tmp_path / "sharded")
+    # a file of an earlier unsharded run, deleted on the wiki since then
+    downloader = make_downloader(server, output)
+    downloader.manifest.mark_seen("Deleted page", os.path.join(output, "en", "Deleted_page.html"), "page")
+    downloader.manifest.mark_written("Deleted page", "0" * 64, EPOCH)
+    downloader.close()
+
+    shards = [sync(server, output, shard=ArchWiki.Shard(i, 2)) for i in range(2)]
+    assert shards[0] and shards[1] and not shards[0] & shards[1]
+    assert shards[0] | shards[1] == expected
+
+    downloader = make_downloader(server, output)
+    downloader.merge_shards(2)
+    merged = {os.path.relpath(path, output) for path in downloader.manifest.paths()}
+    downloader.close()
+    assert merged == expected
+
+
+def test_shard_referenced_images(server, tmp_path):
+    with pytest.raises(ValueError):
+        make_downloader(server, str(tmp_path), shard=ArchWiki.Shard(0, 2), referenced_images=True)
+
+
+def test_redirects(server, tmp_path):
+    output = str(tmp_path)
+    downloader = make_downloader(server, output)
+    downloader.load_link_index()
+    link_index = downloader.optimizer.link_index
+    assert link_index.index["Installation_guides"] == ("en/Installation_guide.html", "Pre-installation")
+
+    # a stale entry of the redirect is recomputed with the update of its target
+    link_index.index["Install"] = ("en/Installation_guide.html", "")
+    link_index.update(["Installation guide"])
+    assert link_index.index["Install"] == ("en/Installation_guide.html", "Installation")
+
+    downloader.process_namespace("0")
+    paths = {os.path.relpath(path, output) for path in downloader.manifest.paths()}
+    downloader.close()
+    # redirects are not downloaded, links to them point to their targets
+    assert "en/Installation_guides.html" not in paths
+    with open(os.path.join(output, "es", "Installation_guide_1.html")) as fd:
+        assert 'href="../en/Installation_guide.html#Pre-installation"' in fd.read()
+
+
+def test_sync_incremental(server, tmp_path):
+    output = str(tmp_path / "incremental")
+    sync(server, output)
+    downloader = make_downloader(server, output)
+    downloader.save_sync_state()
+    downloader.close()
+
+    wiki = server.wiki
+    title = "Installation guide"
+    wiki.edit(title, wiki.pages[title][2].replace("Acquire an installation image", "Acquire the image"))
+    # leaves a redirect behind
+    wiki.move("Installation guide 1", "Installation manual")
+    wiki.delete("Category:Installation process 1")
+    wiki.upload("New-logo.svg", b"<svg/>")
+    wiki.move("File:Arch-logo-1.svg", "File:Moved-logo.svg")
+
+    downloader = make_downloader(server, output)
+    assert downloader.sync_incremental(["0", "14"], clean=True)
+    paths = {os.path.relpath(path, output) for path in downloader.manifest.paths()}
+    downloader.close()
+
+    # the same files as a full sync of the changed wiki
+    assert paths == sync(server, str(tmp_path / "full"))
+    assert {"en/Installation_manual.html", "File:New-logo.svg", "File:Moved-logo.svg"} <= paths
+    assert not os.path.exists(os.path.join(output, "en", "Installation_guide_1.html"))
+    assert not os.path.exists(os.path.join(output, "en", "Category:Installation_process_1.html"))
+    assert not os.path.exists(image_path(output, "Arch-logo-1.svg"))
+    with open(os.path.join(output, "en", "Installation_guide.html")) as fd:
+        assert "Acquire the image" in fd.read()
+
+
+def read_pages(output):
+    pages = {}
+    for lang in ["en", "es"]:
+        for name in os.listdir(os.path.join(output, lang)):
+            with open(os.path.join(output, lang, name)) as fd:
+                pages[f"{lang}/{name}"] = fd.read()
+    return pages
+
+
+def test_reoptimize_offline(server, tmp_path):
+    output = str(tmp_path)
+    # links are resolved in the optimizer processes
+    downloader = make_downloader(server, output, workers=1, optimizer_processes=2)
+    for ns in ["0", "14"]:
+        downloader.process_namespace(ns)
+    downloader.save_snapshot()
+    downloader.close()
+    downloaded = read_pages(output)
+
+    count = server.requests
+    downloader = make_downloader(server, output, optimizer_processes=2)
+    downloader.reoptimize()
+    downloader.close()
+
+    assert downloader.offline
+    assert server.requests == count
+    assert read_pages(output) == downloaded
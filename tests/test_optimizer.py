@@ -0,0 +1,92 @@
+"""
+Golden-file test of the optimizer: the pages of the benchmark corpus are
+optimized and compared with the expected output in tests/golden/. The
+expected output was produced by the original multi-pass implementation.
+The only intended difference is in the thumbnails, whose sources point to
+the original File: path, because only the original file is downloaded.
+Regenerate the files only for deliberate changes of the output:
+
+    PYTHONPATH=. python tests/test_optimizer.py
+"""
+
+import os
+import urllib.parse
+
+import pytest
+
+import ArchWiki
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(TESTS, "..", "benchmarks", "corpus", "pages")
+GOLDEN = os.path.join(TESTS, "golden")
+BASE_DIRECTORY = "/wiki"
+
+NAMESPACES = ["Talk", "ArchWiki", "Help", "Category", "File", "Template", "Special", "User"]
+REDIRECTS = {
+    "Install": "Installation guide#Pre-installation",
+}
+
+
+class StubTitle:
+    def __init__(self, title: str):
+        title = title.replace("_", " ")
+        namespace, sep, pagename = title.partition(":")
+        if sep and namespace in NAMESPACES:
+            self.namespace, self.pagename = namespace, pagename
+        else:
+            self.namespace, self.pagename = "", title
+
+
+class StubRedirects:
+    def resolve(self, title: str) -> str | None:
+        return REDIRECTS.get(title.replace("_", " "))
+
+
+class StubAPI:
+    """The parts of ws.client.API used by the optimizer, without the wiki."""
+
+    def __init__(self):
+        self.redirects = StubRedirects()
+
+    def Title(self, title: str) -> StubTitle:
+        return StubTitle(title)
+
+
+def corpus_pages() -> list[str]:
+    return sorted(f for f in os.listdir(CORPUS) if f.endswith(".html"))
+
+
+def optimize(optimizer: ArchWiki.Optimizer, name: str) -> str:
+    with open(os.path.join(CORPUS, name), encoding="utf-8") as fd:
+        html = fd.read()
+    title = urllib.parse.unquote(name[: -len(".html")]).replace("_", " ")
+    fname = optimizer.get_local_filename(title, BASE_DIRECTORY)
+    return optimizer.optimize(fname, html)
+
+
+@pytest.fixture
+def optimizer() -> ArchWiki.Optimizer:
+    return ArchWiki.Optimizer(StubAPI(), BASE_DIRECTORY, langs=["en", "es"])
+
+
+@pytest.mark.parametrize("name", corpus_pages())
+def test_golden(optimizer, name):
+    with open(os.path.join(GOLDEN, name), encoding="utf-8") as fd:
+        expected = fd.read()
+    assert optimize(optimizer, name) == expected
+
+
+@pytest.mark.parametrize("name", corpus_pages())
+def test_multipass(optimizer, name):
+    with open(os.path.join(CORPUS, name), encoding="utf-8") as fd:
+        html = fd.read()
+    fname = os.path.join(BASE_DIRECTORY, "en", name)
+    assert optimizer.optimize(fname, html) == optimizer.optimize_multipass(fname, html)
+
+
+if __name__ == "__main__":
+    os.makedirs(GOLDEN, exist_ok=True)
+    golden_optimizer = ArchWiki.Optimizer(StubAPI(), BASE_DIRECTORY, langs=["en", "es"])
+    for name in corpus_pages():
+        with open(os.path.join(GOLDEN, name), "w", encoding="utf-8") as fd:
+            fd.write(optimize(golden_optimizer, name))